@@ -2,9 +2,17 @@
 # from . import core
 from .core import *
 
+# Asyncio stuff
+from .aio import AsyncUAVMaster
+
 # Over wire stuff
 # from . import over_wire
 from .aimms30 import Packet
+from .aimms30 import PacketView
+from .aimms30 import find_frame
+from .aimms30 import STATE_RECORD
+from .aimms30 import pack_state_record
+from .aimms30 import unpack_state_record
 from .aimms30 import ParsingError
 from .aimms30 import PacketSizeError
 from .aimms30 import ChecksumMismatch
@@ -28,14 +28,17 @@ RuntimeErrors, the frame is misaligned; move up to the next byte and try
 again. Repeat until aligned. Could do a byte deque?
 '''
 import collections
+import collections.abc
 import struct
+import re
 from .utils import SliceDeque
 from .utils import ParsingError
 from .utils import PacketSizeError
 from .utils import ChecksumMismatch
 
 
-__all__ = ['Packet']
+__all__ = ['Packet', 'PacketView', 'find_frame', 'STATE_RECORD', 
+           'pack_state_record', 'unpack_state_record']
 
 
 def _deque_collapse(data):
@@ -48,6 +51,19 @@ def _deque_collapse(data):
     return out
     
     
+def _as_buffer(data, size):
+    ''' Returns the first size bytes of data as a buffer-supporting 
+    object. Anything already supporting the buffer protocol is sliced
+    directly, ByteRingBuffers are peeked, and deques of single-byte 
+    objects get collapsed.
+    '''
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return data[0:size]
+    if hasattr(data, 'peek'):
+        return data.peek(size)
+    return _deque_collapse(data[0:size])
+    
+    
 def _deque_expand(obj):
     ''' Collapses a deque into a buffer-supporting object.
     '''
@@ -67,6 +83,9 @@ def _make_deque_safe(parser):
                 _deque_expand(parser.pack(value))
             self.unpack = lambda data, parser=parser: \
                 parser.unpack(_deque_collapse(data))
+            # Expose the wire format so it can be compiled into a larger
+            # struct (see _StructCodec).
+            self.format = parser.format
             
     return _Safed()
     
@@ -77,6 +96,7 @@ _INT8_S = struct.Struct('<b')
 _INT16_UN = struct.Struct('<H')
 _INT16_S = struct.Struct('<h')
 _FLOAT32 = struct.Struct('<f')
+_HEADER = struct.Struct('<4B')
 INT8_UN = _make_deque_safe(_INT8_UN)
 INT8_S = _make_deque_safe(_INT8_S)
 INT16_UN = _make_deque_safe(_INT16_UN)
@@ -94,6 +114,9 @@ def _rescale(parser, scale):
                 parser.pack(value * scale)
             self.unpack = lambda data, scale=scale, parser=parser: \
                 [parser.unpack(data)[0] * scale]
+            # Expose the wire format and scale for _StructCodec.
+            self.format = parser.format
+            self.scale = scale
                 
     return _Rescaled()
 
@@ -121,6 +144,8 @@ class STATUS_PARSER():
     MASK_WIND = 1
     MASK_PURGE = 1 << 1
     MASK_GPS = 1 << 2
+    # Wire format, for compilation by _StructCodec.
+    format = _INT8_UN.format
     
     @classmethod
     def pack(cls, flags):
@@ -142,10 +167,15 @@ class STATUS_PARSER():
         
     @classmethod
     def unpack(cls, data):
+        # Turn it into an integer, then into flags
+        return [cls.convert(INT8_UN.unpack(data)[0])]
+        
+    @classmethod
+    def convert(cls, unpacked):
+        ''' Converts an already-unpacked integer into the status flags.
+        '''
         # Initialize with all false
         result = {'wind': False, 'purge': False, 'gps': False}
-        # Turn it into an integer
-        unpacked = INT8_UN.unpack(data)[0]
         # Now apply the masks
         if cls.MASK_WIND & unpacked:
             result['wind'] = True
@@ -154,7 +184,88 @@ class STATUS_PARSER():
         if cls.MASK_GPS & unpacked:
             result['gps'] = True
         # Finally, return
-        return [result]
+        return result
+
+
+class _StructCodec():
+    ''' Compiles a packet component's _MAP and _PARSERS into a single 
+    precomputed struct.Struct plus a scale vector, so the whole component
+    decodes with one unpack_from call instead of one parser per field.
+    
+    Fields are laid out by their offsets in the map; any gaps become pad
+    bytes. Parsers must expose their wire format (see _make_deque_safe,
+    _rescale and STATUS_PARSER); rescaled parsers also expose a scale,
+    and parsers with a convert() hook get it applied after unpacking.
+    '''
+    def __init__(self, _map, parsers):
+        fields = sorted(_map.items(), key=lambda item: item[1][0])
+        
+        codes = '<'
+        cursor = 0
+        keys = []
+        offsets = []
+        formats = []
+        scales = []
+        converters = []
+        # Also memoize a parser per field, for decoding fields one by one.
+        self._fields = {}
+        for index, (key, (first, last)) in enumerate(fields):
+            parser = parsers[key]
+            code = parser.format.lstrip('<=')
+            # Sanity check the map against the parser, since a mismatch 
+            # would silently shift every following field.
+            if struct.calcsize('<' + code) != last - first + 1:
+                raise ValueError('Parser for "' + key + '" does not match '
+                                 'its map width.')
+            if first > cursor:
+                codes += str(first - cursor) + 'x'
+            codes += code
+            cursor = last + 1
+            
+            keys.append(key)
+            offsets.append(first)
+            formats.append(code)
+            scales.append(getattr(parser, 'scale', 1))
+            if hasattr(parser, 'convert'):
+                converters.append((index, parser.convert))
+            self._fields[key] = (struct.Struct('<' + code), first, 
+                                 scales[-1], getattr(parser, 'convert', None))
+        
+        self.struct = struct.Struct(codes)
+        self.keys = tuple(keys)
+        self.offsets = tuple(offsets)
+        self.formats = tuple(formats)
+        self.scales = tuple(scales)
+        self.converters = tuple(converters)
+        # Memoize which fields actually need rescaling.
+        self._rescaled = tuple((index, scale) for index, scale in 
+                               enumerate(self.scales) if scale != 1)
+        
+    def __len__(self):
+        return self.struct.size
+        
+    def unpack_from(self, buffer, offset=0):
+        ''' Decodes the component starting at offset within buffer, 
+        returning a list of values in the same order as self.keys.
+        '''
+        values = list(self.struct.unpack_from(buffer, offset))
+        for index, scale in self._rescaled:
+            values[index] *= scale
+        for index, convert in self.converters:
+            values[index] = convert(values[index])
+        return values
+        
+    def unpack_field(self, key, buffer, offset=0):
+        ''' Decodes only the named field of the component starting at 
+        offset within buffer. Raises KeyError for unknown fields.
+        '''
+        parser, first, scale, convert = self._fields[key]
+        value = parser.unpack_from(buffer, offset + first)[0]
+        if scale != 1:
+            value *= scale
+        if convert:
+            value = convert(value)
+        return value
 
 
 class _PacketHeader():
@@ -187,9 +298,7 @@ class _PacketHeader():
         # body_length: "Number of bytes in data block"
         
         # Need a copy for this shizzit. Don't want to overwrite a mutable...
-        processed = collections.OrderedDict()
-        for key in cls._map:
-            processed[key] = INT8_UN.unpack(raw[key])[0]
+        processed = collections.OrderedDict(raw)
         
         # Do some error checking
         if processed['start'] != 1:
@@ -204,15 +313,13 @@ class _PacketHeader():
     # Parsing a packet requires an existing definition
     @classmethod
     def generate(cls, data):
-        # First create the object
-        c = cls()
-        # Create the internal data store
+        # Unpack the whole header in one go. Don't use a dict 
+        # comprehension so order is preserved
         raw = collections.OrderedDict()
-        # Don't use a dict comprehension so order is preserved
-        for key, slc in cls._map.items():
-            raw[key] = data[slc]
+        for key, value in zip(cls._map, _HEADER.unpack_from(data)):
+            raw[key] = value
         # Process the data into useful things and return it
-        return c._process(raw)
+        return cls._process(raw)
     
         
 # I should refactor these as functions. Maybe as decorators of the build func?
@@ -350,7 +457,7 @@ class _PurgeData():
     _MAP['flow'] = 0, 1
     
     _PARSERS = collections.OrderedDict()
-    _PARSERS = INT16_S
+    _PARSERS['flow'] = INT16_S
     
     @classmethod
     def build(cls, offset):
@@ -421,37 +528,30 @@ class _PacketBody():
     '''
     # Declare all possible packet types
     FMTS = _MeteorologyData, _PositionData, _PurgeData, _TemperatureData
+    # Compile each of them once, keyed by packet ID.
+    _CODECS = {fmt.packet_id: _StructCodec(fmt._MAP, fmt._PARSERS) 
+               for fmt in FMTS}
+    _TYPES = {fmt.packet_id: fmt.packet_type for fmt in FMTS}
     
     def __init__(self, header_data):
-        self._map = None
-        self._parsers = None
-        self._packet_type = None
-        self._len = None
-        
-        # Check each format available
-        for fmt in self.FMTS:
-            # To see if there's a matching packet ID
-            if header_data['id'] == fmt.packet_id:
-                # In which case, assign its map and parsers to self.
-                self._map, self._parsers = fmt.build(_PacketHeader.__len__())
-                self._packet_type = fmt.packet_type
-                self._len = len(fmt())
-                
+        # Look up the precompiled codec for the matching packet ID
+        try:
+            self._codec = self._CODECS[header_data['id']]
         # Now catch an undetected packet type
-        if self._map == None or self._parsers == None:
+        except KeyError:
             raise ValueError('Inappropriate or unsupported packet type ID.')
+        self._packet_type = self._TYPES[header_data['id']]
+        self._offset = _PacketHeader.__len__()
             
     def parse(self, data):
         ''' Takes the full, unadulterated raw data from the packet and 
-        parses away the body, returning it as an ordereddict.
+        parses away the body, returning it as an ordereddict. Data must
+        support the buffer protocol.
         '''
         parsed = collections.OrderedDict()
         parsed['_type'] = self._packet_type
-        for key in self._map:
-            # Use the map to retrieve the appropriate bytes
-            key_bytes = data[self._map[key]]
-            # And then use the parser to make it useful
-            parsed[key] = self._parsers[key].unpack(key_bytes)[0]
+        parsed.update(zip(self._codec.keys, 
+                          self._codec.unpack_from(data, self._offset)))
         # Finally, return the parsed packet.
         return parsed
         
@@ -460,7 +560,7 @@ class _PacketBody():
         header size. Note that this is only available after init, once
         the type has been appropriately declared.
         '''
-        return self._len
+        return len(self._codec)
     
     
 class _PacketFooter():
@@ -481,32 +581,23 @@ class _PacketFooter():
     _PARSERS = collections.OrderedDict()
     _PARSERS['checksum'] = INT16_UN
     
-    def __init__(self, built_map, built_parsers):
-        self._map = built_map
-        self._parsers = built_parsers
+    _CODEC = _StructCodec(_MAP, _PARSERS)
+    
+    def __init__(self, offset):
+        self._offset = offset
     
     @classmethod
     def build(cls, offset):
-        built_map = collections.OrderedDict()
-        built_parsers = cls._PARSERS.copy()
-        # Warning: non-atomic.
-        for key in cls._MAP:
-            relative_ends = cls._MAP[key]
-            start = relative_ends[0] + offset
-            end = relative_ends[1] + 1 + offset
-            built_map[key] = slice(start, end)
-        return cls(built_map, built_parsers)
+        return cls(offset)
             
     def parse(self, data):
         ''' Takes the full, unadulterated raw data from the packet and 
-        parses away the body, returning it as an ordereddict.
+        parses away the footer, returning it as an ordereddict. Data must
+        support the buffer protocol.
         '''
         parsed = collections.OrderedDict()
-        for key in self._map:
-            # Use the map to retrieve the appropriate bytes
-            key_bytes = data[self._map[key]]
-            # And then use the parser to make it useful
-            parsed[key] = self._parsers[key].unpack(key_bytes)[0]
+        parsed.update(zip(self._CODEC.keys, 
+                          self._CODEC.unpack_from(data, self._offset)))
         # Finally, return the parsed packet.
         return parsed
         
@@ -515,6 +606,40 @@ class _PacketFooter():
         return 2
     
     
+# Precompile a pattern matching the start of any supported frame: the SOH
+# byte followed by a known ID and its complement. Using re instead of 
+# bytes.find means memoryviews (ex: from ByteRingBuffer.peek) are scanned
+# without copying, and the ID pairs get checked in the same pass.
+_SOH = 1
+_IDS = frozenset(_PacketBody._CODECS)
+_SYNC = re.compile(bytes([_SOH]) + b'(?:' + b'|'.join(
+    re.escape(bytes([packet_id, 255 - packet_id])) for packet_id in _IDS) + 
+    b')')
+
+
+def find_frame(data, start=0):
+    ''' Returns the offset of the first candidate frame at or after start
+    in a buffer-supporting object, ie an SOH followed by a supported ID 
+    and its complement. Everything before that can't be a packet, so the
+    offset minus start is the number of bytes to skip.
+    
+    If the data ends partway through what could be a header, returns the
+    offset of that partial header so it isn't thrown away before the 
+    rest of it arrives. Otherwise, returns len(data) if no candidate is
+    found.
+    '''
+    match = _SYNC.search(data, start)
+    if match:
+        return match.start()
+    # Nothing complete; check the last two bytes for a partial header.
+    end = len(data)
+    if end - 2 >= start and data[end - 2] == _SOH and data[end - 1] in _IDS:
+        return end - 2
+    if end - 1 >= start and data[end - 1] == _SOH:
+        return end - 1
+    return max(start, end)
+
+
 class Packet(collections.OrderedDict):
     ''' Defines and parses an entire data packet.
     
@@ -538,7 +663,7 @@ class Packet(collections.OrderedDict):
             raise PacketSizeError('Insufficient data length to parse header.')
         
         # Header breakout from data and parsing
-        header = _PacketHeader.generate(data)
+        header = _PacketHeader.generate(_as_buffer(data, _HEADER.size))
         # Body processor construction
         body_builder = _PacketBody(header)
         # Footer processor construction
@@ -553,22 +678,17 @@ class Packet(collections.OrderedDict):
         if len(data) < self.byte_size:
             raise PacketSizeError('Insufficient data length to parse packet.')
         
-        # Now let's breakout and parse the body and footer.
-        body = body_builder.parse(data)
-        footer = footer_builder.parse(data)
-        
-        # This would be a good time for checking the checksum.
-        # But we aren't going to do it yet, because we don't know how.
-        # Because these guys didn't tell us what kind of checksum to do.
+        # Collapse the packet into bytes once, then breakout and parse the 
+        # body and footer from that.
+        self._raw = bytes(_as_buffer(data, self.byte_size))
+        body = body_builder.parse(self._raw)
+        footer = footer_builder.parse(self._raw)
         
         self._checksum = footer['checksum']
-        self._raw = bytes(_deque_collapse(data[0:self.byte_size]))
             
         # Okay, should compare the actual checksum to the calculated one
-        checksum = 0
         # The checksum is a pretty simple byte sum.
-        for i in range(footer_offset):
-            checksum += _INT8_UN.unpack(self._raw[i: i + 1])[0]
+        checksum = sum(self._raw[0:footer_offset])
         # Design decision: raise here, preventing packet recovery.
         if self._checksum != checksum: raise ChecksumMismatch('Bad packet.')
         
@@ -577,9 +697,8 @@ class Packet(collections.OrderedDict):
         self['_type'] = self.packet_type
         self['_good_checksum'] = (self._checksum == checksum)
         
-        # Inefficiently and lazily copy body into self.
-        for key in body:
-            self[key] = body[key]
+        # Lazily copy body into self.
+        self.update(body)
         
     @classmethod
     def from_stream(cls, stream):
@@ -597,7 +716,8 @@ class Packet(collections.OrderedDict):
                 c = cls(stream)
                 break
             except ParsingError:
-                del stream[0]
+                # Jump straight to the next candidate frame.
+                cls.resync(stream, 1)
             except ChecksumMismatch:
                 # In this case, delete the first item in the stream so we 
                 # can continue?
@@ -608,9 +728,213 @@ class Packet(collections.OrderedDict):
         end_of_packet = c.byte_size
         del stream[0:end_of_packet]
         return c
+        
+    @classmethod
+    def decode_many(cls, buffer, start=0, lazy=False):
+        ''' Decodes every complete packet in a buffer-supporting object,
+        starting at start, without mutating it. Returns a list of the
+        packets and the offset of the undecoded tail, ie where to resume
+        once more data has arrived.
+        
+        Unlike from_stream, nothing is raised per packet: misaligned data
+        and packets with bad checksums are simply skipped over.
+        
+        If lazy, returns compact PacketViews instead of Packets.
+        '''
+        packets = []
+        end = len(buffer)
+        offset = start
+        header_size = _HEADER.size
+        footer_size = _PacketFooter.__len__()
+        while True:
+            offset = find_frame(buffer, offset)
+            # Stop at a partial header...
+            if offset + header_size > end:
+                break
+            packet_id = buffer[offset + 1]
+            footer_offset = header_size + len(_PacketBody._CODECS[packet_id])
+            # ...or a partial packet.
+            if offset + footer_offset + footer_size > end:
+                break
+            raw = bytes(buffer[offset:offset + footer_offset + footer_size])
+            checksum = _INT16_UN.unpack_from(raw, footer_offset)[0]
+            if checksum != sum(raw[0:footer_offset]):
+                offset += 1
+                continue
+            if lazy:
+                packets.append(PacketView(raw, packet_id))
+            else:
+                packets.append(cls._from_raw(raw, packet_id, checksum))
+            offset += len(raw)
+        return packets, offset
+        
+    @classmethod
+    def _from_raw(cls, raw, packet_id, checksum):
+        ''' Builds a packet from its complete, already validated raw 
+        bytes, skipping all of the checks in __init__.
+        '''
+        c = cls.__new__(cls)
+        collections.OrderedDict.__init__(c)
+        codec = _PacketBody._CODECS[packet_id]
+        c.byte_size = len(raw)
+        c._raw = raw
+        c._checksum = checksum
+        c._packet_type = _PacketBody._TYPES[packet_id]
+        c['_type'] = c._packet_type
+        c['_good_checksum'] = True
+        c.update(zip(codec.keys, codec.unpack_from(raw, _HEADER.size)))
+        return c
+        
+    @classmethod
+    def resync(cls, stream, start=0):
+        ''' Discards everything in a deque-like stream before the next 
+        candidate frame at or after start (see find_frame), returning 
+        the number of bytes skipped.
+        '''
+        skipped = find_frame(_as_buffer(stream, len(stream)), start)
+        if skipped:
+            del stream[0:skipped]
+        return skipped
     
     @property
     def packet_type(self):
         ''' Read-only property to return the parsed packet type.
         '''
-        return self._packet_type
\ No newline at end of file
+        return self._packet_type
+        
+        
+class PacketView(collections.abc.Mapping):
+    ''' Compact, read-only alternative to a Packet.
+    
+    Holds nothing but one packet's raw bytes (a bytes object, or a 
+    memoryview onto a buffer that won't be reused) and its type ID, and
+    only decodes fields as they are accessed. Keys are the same as for a
+    Packet. Use to_dict() wherever a real dict is needed, ex: for JSON.
+    
+    Views should only be made from packets with good checksums (as in
+    Packet.decode_many); the checksum is not rechecked.
+    '''
+    __slots__ = ('_raw', '_packet_id')
+    
+    def __init__(self, raw, packet_id=None):
+        self._raw = raw
+        if packet_id is None:
+            packet_id = raw[1]
+        self._packet_id = packet_id
+        
+    def __getitem__(self, key):
+        if key == '_type':
+            return self.packet_type
+        if key == '_good_checksum':
+            return True
+        return _PacketBody._CODECS[self._packet_id].unpack_field(
+            key, self._raw, _HEADER.size)
+            
+    def __iter__(self):
+        yield '_type'
+        yield '_good_checksum'
+        yield from _PacketBody._CODECS[self._packet_id].keys
+        
+    def __len__(self):
+        return len(_PacketBody._CODECS[self._packet_id].keys) + 2
+        
+    def __repr__(self):
+        return type(self).__name__ + '(' + repr(self.to_dict()) + ')'
+        
+    def to_dict(self):
+        ''' Decodes the whole packet at once, returning an ordereddict 
+        equal to the corresponding Packet.
+        '''
+        codec = _PacketBody._CODECS[self._packet_id]
+        out = collections.OrderedDict()
+        out['_type'] = self.packet_type
+        out['_good_checksum'] = True
+        out.update(zip(codec.keys, codec.unpack_from(self._raw, _HEADER.size)))
+        return out
+        
+    @property
+    def packet_type(self):
+        return _PacketBody._TYPES[self._packet_id]
+        
+    @property
+    def byte_size(self):
+        return len(self._raw)
+        
+    @property
+    def raw(self):
+        return self._raw
+        
+# Fixed-layout binary record of the latest merged AIMMS state, for 
+# consumers that would rather not parse JSON (ex: LabVIEW, embedded).
+# Little-endian, no padding, 192 bytes:
+#
+#   offset  type     field
+#   0       uint16   layout (STATE_RECORD_LAYOUT; bumped on any change)
+#   2       uint16   size (STATE_RECORD.size, ie 192)
+#   4       uint32   flags (see below)
+#   8       uint64   version (state version; increments on every packet)
+#   16      double   timestamp (unix time of the latest packet)
+#   24      double   x7  met fields, in STATE_RECORD_MET order
+#   80      double   x14 position fields, in STATE_RECORD_POSITION order
+#
+# flags bits 0-2 are the met status flags, exactly as on the wire 
+# (STATUS_PARSER: 0 wind, 1 purge, 2 gps). Bit 8 is set once any met 
+# packet has been received, and bit 9 once any position packet has. 
+# Fields that haven't been received yet are NaN.
+STATE_RECORD_LAYOUT = 1
+STATE_RECORD_MET = ('temperature', 'rh', 'pressure', 'wind_vector_north', 
+                    'wind_vector_east', 'wind_speed', 'wind_direction')
+STATE_RECORD_POSITION = ('latitude', 'longitude', 'altitude', 
+                         'velocity_north', 'velocity_east', 'velocity_down',
+                         'roll', 'pitch', 'yaw', 'airspeed', 'wind_vertical',
+                         'sideslip', 'aoa_differential', 
+                         'sideslip_differential')
+STATE_RECORD_FLAG_MET = 1 << 8
+STATE_RECORD_FLAG_POSITION = 1 << 9
+STATE_RECORD = struct.Struct('<HHIQd' + 
+                             'd' * len(STATE_RECORD_MET) + 
+                             'd' * len(STATE_RECORD_POSITION))
+
+
+def pack_state_record(state, version=0):
+    ''' Packs a merged AIMMS state dict (ie state['aimms']) into a
+    STATE_RECORD.
+    '''
+    nan = float('nan')
+    flags = 0
+    status = state.get('status')
+    if status:
+        flags |= STATUS_PARSER.MASK_WIND if status.get('wind') else 0
+        flags |= STATUS_PARSER.MASK_PURGE if status.get('purge') else 0
+        flags |= STATUS_PARSER.MASK_GPS if status.get('gps') else 0
+    if any(key in state for key in STATE_RECORD_MET):
+        flags |= STATE_RECORD_FLAG_MET
+    if any(key in state for key in STATE_RECORD_POSITION):
+        flags |= STATE_RECORD_FLAG_POSITION
+    values = [float(state.get(key, nan)) 
+              for key in STATE_RECORD_MET + STATE_RECORD_POSITION]
+    return STATE_RECORD.pack(STATE_RECORD_LAYOUT, STATE_RECORD.size, flags,
+                             version or 0, state.get('timestamp', nan), 
+                             *values)
+
+
+def unpack_state_record(data):
+    ''' Unpacks a STATE_RECORD into an ordereddict, with the flags 
+    broken out (as 'status', 'has_met' and 'has_position'). Raises 
+    ParsingError on a layout or size mismatch.
+    '''
+    if len(data) != STATE_RECORD.size:
+        raise ParsingError('State record must be ' + 
+                           str(STATE_RECORD.size) + ' bytes.')
+    layout, size, flags, version, timestamp, *values = \
+        STATE_RECORD.unpack(data)
+    if layout != STATE_RECORD_LAYOUT or size != STATE_RECORD.size:
+        raise ParsingError('Unsupported state record layout.')
+    out = collections.OrderedDict()
+    out['version'] = version
+    out['timestamp'] = timestamp
+    out['status'] = STATUS_PARSER.convert(flags)
+    out['has_met'] = bool(flags & STATE_RECORD_FLAG_MET)
+    out['has_position'] = bool(flags & STATE_RECORD_FLAG_POSITION)
+    out.update(zip(STATE_RECORD_MET + STATE_RECORD_POSITION, values))
+    return out
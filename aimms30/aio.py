@@ -0,0 +1,221 @@
+''' asyncio counterparts to the threaded UAV components in core
+
+Everything runs in a single event loop with no threads at all: serial
+data is read as soon as the loop's file-descriptor reader says it's
+there, packets are decoded in bulk and ingested straight away, the
+status server is an asyncio.start_server, and recorded objects are
+written out in batches.
+
+Platforms without selectable serial ports (ie Windows) fall back to
+polling the port from a task.
+'''
+import asyncio
+import io
+import json
+import serial
+from .aimms30 import Packet as AimmsPacket
+from .core import PacketSink
+from .core import next_filename
+from .core import _to_dict
+from .utils import resolve_path
+
+
+__all__ = ['AsyncSerialDigester', 'AsyncFileRecorder', 'AsyncStatusServer',
+           'AsyncUAVMaster']
+
+
+class AsyncSerialDigester():
+    ''' Reads a serial port from the event loop, decodes everything that
+    has arrived with batch_decoder (ex: AimmsPacket.decode_many), and
+    hands each packet to on_packet.
+    '''
+    def __init__(self, port, baud, on_packet,
+                 batch_decoder=AimmsPacket.decode_many, chunk_size=4096,
+                 poll_interval=.01):
+        self.connection = serial.Serial()
+        self.connection.baudrate = baud
+        self.connection.port = port
+        # Never block the loop.
+        self.connection.timeout = 0
+        self.on_packet = on_packet
+        self.batch_decoder = batch_decoder
+        self.poll_interval = poll_interval
+        # Only ever touched from the loop, so no need for a ring buffer.
+        self.buffer = bytearray()
+        self._chunk = memoryview(bytearray(chunk_size))
+        self._fd = None
+        self._poller = None
+        self.skipped_bytes = 0
+
+    def start(self, loop):
+        self.connection.open()
+        try:
+            self._fd = self.connection.fileno()
+            loop.add_reader(self._fd, self.on_readable)
+        except (AttributeError, NotImplementedError, io.UnsupportedOperation):
+            self._fd = None
+            self._poller = loop.create_task(self._poll())
+
+    def stop(self, loop):
+        if self._fd is not None:
+            loop.remove_reader(self._fd)
+            self._fd = None
+        if self._poller:
+            self._poller.cancel()
+            self._poller = None
+        self.connection.close()
+
+    async def _poll(self):
+        while True:
+            self.on_readable()
+            await asyncio.sleep(self.poll_interval)
+
+    def on_readable(self):
+        ''' Reads everything waiting on the connection, then digests it.
+        '''
+        size = min(max(self.connection.in_waiting, 1), len(self._chunk))
+        count = self.connection.readinto(self._chunk[:size])
+        if not count:
+            return
+        self.buffer.extend(self._chunk[:count])
+
+        packets, offset = self.batch_decoder(self.buffer)
+        del self.buffer[0:offset]
+        self.skipped_bytes += offset - sum(packet.byte_size
+                                           for packet in packets)
+        for packet in packets:
+            self.on_packet(packet)
+
+
+class AsyncFileRecorder():
+    ''' Collects objects and appends them to a file as JSON lines, in
+    one write per batch. Batches are written every flush_interval
+    seconds by run(), or as soon as max_batch objects are waiting.
+    '''
+    def __init__(self, filename, flush_interval=.5, max_batch=1000):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending = []
+        self._f = None
+
+    def schedule_object(self, obj):
+        ''' Schedules an object to be recorded to the file.
+        '''
+        self._pending.append(obj)
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+
+    def flush(self):
+        ''' Writes out everything pending.
+        '''
+        if not self._pending:
+            return
+        # Open, if it hasn't been opened yet.
+        if not self._f:
+            self._f = open(self.filename, 'a+')
+        self._f.writelines(json.dumps(obj, default=_to_dict) + '\n'
+                           for obj in self._pending)
+        self._f.flush()
+        self._pending = []
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        if self._f:
+            self._f.close()
+        self._f = None
+
+
+class AsyncStatusServer():
+    ''' Minimal HTTP server for the state vector, with the same RESTful
+    path handling as RestfulDictHandler. One request per connection.
+    '''
+    def __init__(self, port, state_vector, verbose=False):
+        self.port = port
+        self.state_vector = state_vector
+        self.verbose = verbose
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '', self.port)
+
+    async def serve_forever(self):
+        await self.server.serve_forever()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def handle(self, reader, writer):
+        try:
+            request = (await reader.readline()).decode('latin-1')
+            # Discard the headers; nothing in them is needed.
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            try:
+                method, path, version = request.split()
+            except ValueError:
+                return self._respond(writer, 400)
+            if self.verbose:
+                print(request.strip())
+            if method not in ('GET', 'HEAD'):
+                return self._respond(writer, 501)
+
+            try:
+                _state = resolve_path(self.state_vector, path)
+            except KeyError:
+                return self._respond(writer, 404)
+            body = json.dumps(_state).encode()
+            self._respond(writer, 200, body, head_only=(method == 'HEAD'))
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _respond(writer, code, body=b'', head_only=False):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                   501: 'Not Implemented'}
+        writer.write(('HTTP/1.0 ' + str(code) + ' ' + reasons[code] + '\r\n'
+                      'Content-type: text/plain\r\n'
+                      'Content-Length: ' + str(len(body)) + '\r\n'
+                      'Connection: close\r\n'
+                      '\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+
+
+class AsyncUAVMaster(PacketSink):
+    ''' Single-threaded, asyncio equivalent of UAVMaster.
+    '''
+    def __init__(self, aimms_port, http_port, record_to_file=True,
+                 print_to_terminal=False, flush_interval=.5, *args, **kwargs):
+        super().__init__(record_to_file=record_to_file,
+                         print_to_terminal=print_to_terminal, *args, **kwargs)
+        self.aimms = AsyncSerialDigester(port=aimms_port, baud=115200,
+                                         on_packet=self.ingest)
+        self.recorder = AsyncFileRecorder(filename=next_filename(),
+                                          flush_interval=flush_interval)
+        self.server = AsyncStatusServer(http_port, state_vector=self.state,
+                                        verbose=print_to_terminal)
+
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        await self.server.start()
+        self.aimms.start(loop)
+        flusher = loop.create_task(self.recorder.run())
+        try:
+            await self.server.serve_forever()
+        finally:
+            self.aimms.stop(loop)
+            flusher.cancel()
+            self.recorder.close()
+            self.server.close()
@@ -0,0 +1,172 @@
+''' Vectorized decoding of recorded raw AIMMS-30 captures into columns
+
+Meant for post-flight analysis of the raw serial bytes saved by, ex,
+test/packet_recorder.py. Instead of building a Packet per frame, frames
+are located and validated with array operations, and each packet type
+is viewed through a NumPy structured dtype built from the same compiled
+codecs that Packet uses, so the scales always agree.
+
+Unlike the rest of the package, this needs NumPy. It is therefore not
+imported by aimms30/__init__.py; use "from aimms30 import columnar".
+'''
+import collections
+import os
+import numpy as np
+from .aimms30 import STATUS_PARSER
+from .aimms30 import _PacketBody
+from .aimms30 import _PacketFooter
+from .aimms30 import _HEADER
+from .aimms30 import _SOH
+
+
+__all__ = ['frame_offsets', 'decode_capture', 'decode_capture_file']
+
+
+# Layout of a RawCapture index record (see core.RawCapture.INDEX_RECORD).
+_INDEX_DTYPE = np.dtype([('time', '<f8'), ('offset', '<u8')])
+
+# Map struct codes (as compiled by _StructCodec) onto NumPy types.
+_DTYPES = {
+    'B': 'u1',
+    'b': 'i1',
+    'H': '<u2',
+    'h': '<i2',
+    'f': '<f4',
+    }
+
+
+def _body_dtype(codec):
+    ''' Builds a structured dtype matching a compiled packet body codec.
+    '''
+    return np.dtype({'names': list(codec.keys),
+                     'formats': [_DTYPES[code] for code in codec.formats],
+                     'offsets': list(codec.offsets),
+                     'itemsize': len(codec)})
+
+
+def _frame_size(packet_id):
+    return _HEADER.size + len(_PacketBody._CODECS[packet_id]) + \
+        _PacketFooter.__len__()
+
+
+def _gather(data, offsets, size):
+    ''' Returns a (len(offsets), size) array of the bytes at each offset.
+    '''
+    return data[offsets[:, None] + np.arange(size)]
+
+
+def frame_offsets(data):
+    ''' Finds every valid packet in a uint8 array. Returns two arrays:
+    the byte offset of each packet and its packet ID, in order.
+
+    A valid packet has a proper header, a supported ID, and a good
+    checksum. Should any run of bytes inside a real packet also look
+    like one, the overlap is resolved by walking forward from the
+    earliest packet, just as a stream parser would.
+    '''
+    if len(data) < 3:
+        return np.zeros(0, np.int64), np.zeros(0, np.uint8)
+
+    # Candidate headers: SOH, then an ID and its complement.
+    candidates = np.flatnonzero(
+        (data[:-2] == _SOH) &
+        (data[1:-1].astype(np.uint16) + data[2:] == 255))
+    ids = data[candidates + 1]
+
+    # Validate the checksum of each candidate, one packet type at a time.
+    found = []
+    for packet_id in _PacketBody._CODECS:
+        size = _frame_size(packet_id)
+        selected = candidates[ids == packet_id]
+        selected = selected[selected + size <= len(data)]
+        frames = _gather(data, selected, size).astype(np.int64)
+        checksums = frames[:, -2] | (frames[:, -1] << 8)
+        good = frames[:, :-2].sum(axis=1) == checksums
+        found.append(selected[good])
+    offsets = np.sort(np.concatenate(found))
+
+    # Now resolve any overlaps.
+    keep = np.zeros(len(offsets), bool)
+    next_offset = 0
+    for index, offset in enumerate(offsets.tolist()):
+        if offset >= next_offset:
+            keep[index] = True
+            next_offset = offset + _frame_size(int(data[offset + 1]))
+    offsets = offsets[keep]
+    return offsets, data[offsets + 1]
+
+
+def decode_capture(data):
+    ''' Decodes a raw capture (any bytes-like object or uint8 array) into
+    columns. Returns an OrderedDict mapping each packet type present to
+    an OrderedDict of equal-length column arrays.
+
+    The first column, 'offset', is the byte offset of each packet within
+    the capture. The rest are the packet fields, rescaled exactly as
+    Packet would (rescaled fields are float64; the rest keep their wire
+    types). The status byte becomes boolean 'status_wind',
+    'status_purge' and 'status_gps' columns.
+    '''
+    data = np.frombuffer(data, dtype=np.uint8)
+    offsets, ids = frame_offsets(data)
+
+    decoded = collections.OrderedDict()
+    for fmt in _PacketBody.FMTS:
+        codec = _PacketBody._CODECS[fmt.packet_id]
+        selected = offsets[ids == fmt.packet_id]
+        if not len(selected):
+            continue
+        records = _gather(data, selected + _HEADER.size, len(codec))
+        records = records.view(_body_dtype(codec))[:, 0]
+        converted = dict(codec.converters)
+
+        columns = collections.OrderedDict()
+        columns['offset'] = selected
+        for index, (key, scale) in enumerate(zip(codec.keys, codec.scales)):
+            column = records[key]
+            if converted.get(index) == STATUS_PARSER.convert:
+                columns[key + '_wind'] = \
+                    (column & STATUS_PARSER.MASK_WIND).astype(bool)
+                columns[key + '_purge'] = \
+                    (column & STATUS_PARSER.MASK_PURGE).astype(bool)
+                columns[key + '_gps'] = \
+                    (column & STATUS_PARSER.MASK_GPS).astype(bool)
+            elif scale != 1:
+                columns[key] = column.astype(np.float64) * scale
+            else:
+                columns[key] = np.ascontiguousarray(column)
+        decoded[fmt.packet_type] = columns
+
+    return decoded
+
+
+def decode_capture_file(filename, index_filename=None):
+    ''' Memory-maps a raw capture file and decodes it (see
+    decode_capture).
+
+    If the capture has a RawCapture index (by default, filename +
+    '.idx'), each packet type also gets a 'time' column: the monotonic
+    time at which the chunk completing each packet was read.
+    '''
+    # Empty files can't be mapped.
+    if not os.path.getsize(filename):
+        return collections.OrderedDict()
+    decoded = decode_capture(np.memmap(filename, dtype=np.uint8, mode='r'))
+
+    if index_filename is None:
+        index_filename = filename + '.idx'
+    if os.path.isfile(index_filename):
+        index = np.fromfile(index_filename, dtype=_INDEX_DTYPE)
+        for fmt in _PacketBody.FMTS:
+            columns = decoded.get(fmt.packet_type)
+            if columns is None:
+                continue
+            # Find the chunk holding the last byte of each packet.
+            last = columns['offset'] + _frame_size(fmt.packet_id) - 1
+            chunks = np.searchsorted(index['offset'], last, 'right') - 1
+            # Anything from before the index started has no time.
+            columns['time'] = np.where(chunks >= 0,
+                                       index['time'][np.maximum(chunks, 0)],
+                                       np.nan)
+
+    return decoded
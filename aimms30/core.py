@@ -19,17 +19,29 @@ from queue import Queue
 from queue import Empty
 from queue import Full
 import os
+import re
+import glob
 import json
+import struct
+import shutil
+import gzip
+import lzma
 from .aimms30 import Packet as AimmsPacket
+from .aimms30 import pack_state_record
+from .logs import iter_log
+from .history import TimeSeriesStore
 from .utils import PacketSizeError
 from .utils import ChecksumMismatch
 from .utils import ParsingError
 from .utils import SliceDeque
+from .utils import ByteRingBuffer
 from .utils import MinimumLoopDelay
 from .utils import RestfulDictHandler
 from .utils import QuietRestfulDictHandler
 from .utils import TestHandler
 from .utils import ThreadedStatefulSocketServer
+from .utils import StateVector
+from .utils import PacketBroadcaster
 from abc import ABCMeta
 from abc import abstractmethod
 import http.server
@@ -47,10 +59,44 @@ checksum_warning = \
 #########################################################'''
 
 
+def next_filename(prefix='sample_data_', ext='.txt', 
+                  companions=('.dat', '.manifest')):
+    ''' Returns the first prefix + N + ext that doesn't exist yet, and
+    whose companions (ie prefix + N + each of companions, ex: a raw 
+    capture) and rotated segments (prefix + N + '-0001' + ..., see 
+    FileRecorder) don't either. That way, a run's files always share an
+    N, and never clobber another run's.
+    '''
+    suffix = 1
+    while True:
+        stem = prefix + str(suffix)
+        if not any(os.path.isfile(stem + extension) 
+                   for extension in (ext,) + tuple(companions)) and \
+            not glob.glob(glob.escape(stem) + '-[0-9]*'):
+                return stem + ext
+        suffix += 1
+
+
+def _to_dict(obj):
+    ''' JSON fallback for lazily-decoded objects, ex: PacketViews.
+    '''
+    try:
+        return obj.to_dict()
+    except AttributeError:
+        raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
 class ThreadMonster():
-    def __init__(self, create_master=False, *args, **kwargs):
+    def __init__(self, create_master=False, event_driven=False, 
+                 wait_timeout=.1, *args, **kwargs):
+        ''' If event_driven, tasks block until they have work to do, 
+        instead of polling on a fixed loop delay. They still wake up at
+        least every wait_timeout seconds to check the exit flag.
+        '''
         super().__init__(*args, **kwargs)
         self.exit_flag = Event()
+        self.event_driven = event_driven
+        self.wait_timeout = wait_timeout
         
         self._threads = {}
         if create_master:
@@ -115,38 +161,224 @@ class ThreadMonster():
 
 
 class FileRecorder(ThreadMonster):
-    def __init__(self, filename, *args, **kwargs):
+    # Supported compressions, as (opener, file extension).
+    COMPRESSORS = {'gzip': (gzip.open, '.gz'),
+                   'lzma': (lzma.open, '.xz')}
+    
+    def __init__(self, filename, batch=False, flush_bytes=65536, 
+                 flush_interval=1., fsync=False, rotate_bytes=None,
+                 rotate_interval=None, compression=None, *args, **kwargs):
+        ''' If batch, each dump drains everything queued and writes it 
+        all at once. Either way, the file is flushed once flush_bytes 
+        have been written since the last flush, or once flush_interval
+        seconds have passed with anything unflushed; if fsync, flushes
+        are also synced to disk.
+        
+        If rotate_bytes or rotate_interval (seconds) are given, output is
+        split into numbered segments (ex: sample_data_1-0001.txt), with a
+        new one started once the current one reaches either limit. If 
+        compression is 'gzip' or 'lzma', each closed segment is then 
+        compressed by a background thread. Either way, every closed 
+        segment is listed (as a JSON line) in a manifest file next to
+        them (ex: sample_data_1.manifest).
+        '''
         super().__init__(*args, **kwargs)
         self.filename = filename
+        self.batch = batch
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_bytes = rotate_bytes
+        self.rotate_interval = rotate_interval
+        if compression is not None and compression not in self.COMPRESSORS:
+            raise ValueError('Unsupported compression: ' + str(compression))
+        self.compression = compression
         self._file_q = Queue()
+        if self.event_driven:
+            no_faster_than = 0
+        else:
+            no_faster_than = .001
         self.add_thread(task=self.dump, name='file_recorder', 
-                        no_faster_than=.001)
+                        no_faster_than=no_faster_than)
         self._f = None
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        
+        # Segment bookkeeping
+        stem, ext = os.path.splitext(filename)
+        self._segment_template = stem + '-{:04d}' + ext
+        self.manifest = stem + '.manifest'
+        self._segmented = bool(rotate_bytes or rotate_interval or compression)
+        self._segment = None
+        # Carry on numbering after any segments already there.
+        self._segments = self._last_segment(stem, ext)
+        self._closed_q = Queue()
+        if self._segmented:
+            self.add_thread(task=self.compress, name='file_compressor',
+                            no_faster_than=0)
     
     def dump(self):
         ''' Appends a string to the supplied file and adds a newline.
         '''
         # If there's an item on the queue, grab it and execute; otherwise nvm
         try:
-            obj = self._file_q.get_nowait()
+            if self.event_driven:
+                obj = self._file_q.get(timeout=self.wait_timeout)
+            else:
+                obj = self._file_q.get_nowait()
         except Empty:
+            # Still flush on time, even when idle.
+            self._flush()
             return
             
+        objs = [obj]
+        if self.batch:
+            objs.extend(self._drain())
+        self._write(objs)
+        self._flush()
+        
+    def _drain(self):
+        ''' Pops everything currently queued.
+        '''
+        objs = []
+        try:
+            while True:
+                objs.append(self._file_q.get_nowait())
+        except Empty:
+            return objs
+        
+    def _write(self, objs):
+        ''' Serializes objs in one pass, and writes them in one call.
+        '''
+        if not objs:
+            return
+        if self._f and self._should_rotate():
+            self._close_segment()
         # Open, if it hasn't been opened yet.
         if not self._f:
+            self._open_segment()
+        lines = [json.dumps(obj, default=_to_dict) + '\n' for obj in objs]
+        self._f.writelines(lines)
+        written = sum(len(line) for line in lines)
+        self._unflushed += written
+        if self._segment:
+            self._segment['bytes'] += written
+            self._segment['lines'] += len(lines)
+        
+    def _flush(self, force=False):
+        ''' Flushes (and maybe fsyncs) the file, if the policy says so.
+        '''
+        if not self._f or not self._unflushed:
+            return
+        now = time.monotonic()
+        if force or self._unflushed >= self.flush_bytes or \
+            now - self._last_flush >= self.flush_interval:
+                self._f.flush()
+                if self.fsync:
+                    os.fsync(self._f.fileno())
+                self._unflushed = 0
+                self._last_flush = now
+                
+    def _should_rotate(self):
+        if not self._segment:
+            return False
+        if self.rotate_bytes and self._segment['bytes'] >= self.rotate_bytes:
+            return True
+        if self.rotate_interval and \
+            time.time() - self._segment['opened'] >= self.rotate_interval:
+                return True
+        return False
+                
+    @classmethod
+    def _last_segment(cls, stem, ext):
+        ''' Returns the highest segment number already used for stem (in
+        any state of compression), or 0.
+        '''
+        pattern = re.compile(re.escape(os.path.basename(stem)) + 
+                             r'-(\d+)' + re.escape(ext) + r'(\.\w+)*$')
+        last = 0
+        for path in glob.glob(glob.escape(stem) + '-[0-9]*'):
+            match = pattern.match(os.path.basename(path))
+            if match:
+                last = max(last, int(match.group(1)))
+        return last
+        
+    def _open_segment(self):
+        if not self._segmented:
             self._f = open(self.filename, 'a+')
+            return
+        if self.rotate_bytes or self.rotate_interval:
+            self._segments += 1
+            path = self._segment_template.format(self._segments)
+            # Never reuse a segment, compressed or not.
+            while glob.glob(glob.escape(path) + '*'):
+                self._segments += 1
+                path = self._segment_template.format(self._segments)
+        else:
+            path = self.filename
+        self._f = open(path, 'a+')
+        self._segment = {'segment': path, 'opened': time.time(), 
+                         'closed': None, 'bytes': 0, 'lines': 0,
+                         'compression': None}
+        
+    def _close_segment(self):
+        ''' Closes the current file, handing it off for compression.
+        '''
+        self._flush(force=True)
+        self._f.close()
+        self._f = None
+        if self._segment:
+            self._segment['closed'] = time.time()
+            self._closed_q.put_nowait(self._segment)
+            self._segment = None
+            
+    def compress(self):
+        ''' Compresses closed segments (if configured) and lists them in
+        the manifest. Runs in its own thread, off of the write path.
+        '''
+        try:
+            segment = self._closed_q.get(timeout=self.wait_timeout)
+        except Empty:
+            return
+        self._finish_segment(segment)
         
-        s = json.dumps(obj)
-        self._f.write(s)
-        self._f.write('\n')
+    def _finish_segment(self, segment):
+        opener, ext = self.COMPRESSORS.get(self.compression, (None, None))
+        path = segment['segment']
+        # Never replace an existing compressed file; if there is one, 
+        # leave this segment uncompressed instead.
+        if self.compression and not os.path.exists(path + ext):
+            # Compress to a temporary name, so a partial file never 
+            # looks finished.
+            with open(path, 'rb') as src, opener(path + ext + '.part', 
+                                                 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(path + ext + '.part', path + ext)
+            os.remove(path)
+            segment['segment'] = path + ext
+            segment['compression'] = self.compression
+        with open(self.manifest, 'a+') as f:
+            f.write(json.dumps(segment) + '\n')
         
     def __exit__(self, *args, **kwargs):
-        # Close our file, then call super.
+        # Call super to stop the dump thread and let it finish up.
+        super().__exit__(*args, **kwargs)
+        for name in ('file_recorder', 'file_compressor'):
+            thread = self.threads.get(name)
+            if thread and thread.is_alive():
+                thread.join(self.wait_timeout + 1)
+        # Write out whatever it left behind, then close our file.
+        self._write(self._drain())
         if self._f:
-            self._f.close()
+            self._close_segment()
+        # Finish off any segments the compressor didn't get to.
+        try:
+            while True:
+                self._finish_segment(self._closed_q.get_nowait())
+        except Empty:
+            pass
         # Reset state, regardless (tiny performance hit; reliability assurance)
         self._f = None
-        super().__exit__(*args, **kwargs)
             
     def schedule_object(self, obj):
         ''' Schedules an object to be recorded to the file. Threadsafe.
@@ -154,18 +386,85 @@ class FileRecorder(ThreadMonster):
         self._file_q.put_nowait(obj)
         
 
+class RawCapture():
+    ''' Append-only recording of raw serial bytes, for decoding offline
+    (ex: with aimms30.columnar). Alongside the capture, keeps an index 
+    (by default, filename + '.idx') of fixed-size, little-endian 
+    (monotonic time, byte offset) records: one per chunk written.
+    '''
+    INDEX_RECORD = struct.Struct('<dQ')
+    
+    def __init__(self, filename, index_filename=None):
+        self.filename = filename
+        if index_filename is None:
+            index_filename = filename + '.idx'
+        self.index_filename = index_filename
+        self._f = None
+        self._index = None
+        self._offset = 0
+        
+    def open(self):
+        self._f = open(self.filename, 'ab')
+        self._index = open(self.index_filename, 'ab')
+        # Appending; pick up where any previous capture left off.
+        self._offset = self._f.tell()
+        
+    def write(self, data):
+        ''' Appends a chunk of raw data and indexes it. NOT threadsafe; 
+        meant to be called from the SerialListener thread only.
+        '''
+        self._index.write(self.INDEX_RECORD.pack(time.monotonic(), 
+                                                 self._offset))
+        self._f.write(data)
+        self._offset += len(data)
+        
+    def close(self):
+        for f in (self._f, self._index):
+            if f:
+                f.close()
+        self._f = None
+        self._index = None
+        
+    @classmethod
+    def read_index(cls, index_filename):
+        ''' Returns the (monotonic time, byte offset) records of an index.
+        '''
+        with open(index_filename, 'rb') as f:
+            data = f.read()
+        # Ignore any partially-written trailing record.
+        data = data[0:len(data) - len(data) % cls.INDEX_RECORD.size]
+        return list(cls.INDEX_RECORD.iter_unpack(data))
+        
+
 class SerialListener(ThreadMonster):
-    def __init__(self, port, baud, *args, **kwargs):
+    def __init__(self, port, baud, read_timeout=.01, chunk_size=4096, 
+                 capture=None, *args, **kwargs):
+        ''' Each read pulls in everything waiting on the port (up to 
+        chunk_size bytes) in one call. If nothing is waiting, it blocks 
+        for up to read_timeout seconds for the first byte, so the loop 
+        needs no sleep to keep from busy-polling. A read_timeout of 0 
+        makes reads non-blocking, and the loop is throttled instead.
+        
+        If a RawCapture is given, everything read is also written to it,
+        straight from the listener thread.
+        '''
         super().__init__(*args, **kwargs)
+        self.capture = capture
         # Sets (ex: self.COM5_ser) to be the serial connection
         self.connection = serial.Serial()
         self.connection.baudrate = baud
         self.connection.port = port
-        self.connection.timeout = 0
-        # Sets (ex: self.COM5_buffer) to be a slicedeque
-        self.buffer = SliceDeque()
+        self.connection.timeout = read_timeout
+        # Sets (ex: self.COM5_buffer) to be a byte ring buffer
+        self.buffer = ByteRingBuffer()
+        # Preallocate the buffer to read into
+        self._chunk = memoryview(bytearray(chunk_size))
+        if read_timeout:
+            no_faster_than = 0
+        else:
+            no_faster_than = .001
         self.add_thread(task=self.listen, name='serial_listener', 
-                        no_faster_than=.001)
+                        no_faster_than=no_faster_than)
         
     def stop(self):
         self.connection.close()
@@ -173,60 +472,150 @@ class SerialListener(ThreadMonster):
         
     def start(self):
         self.connection.open()
+        if self.capture:
+            self.capture.open()
         super().start()
+        
+    def __exit__(self, *args, **kwargs):
+        super().__exit__(*args, **kwargs)
+        # Only close the capture once the listener is done writing to it.
+        if self.capture:
+            thread = self.threads['serial_listener']
+            if thread.is_alive():
+                thread.join((self.connection.timeout or 0) + 1)
+            self.capture.close()
      
     def listen(self):
-        '''  Listens on a connection using connection.read(), returning the
-        first read byte. Assumes the connection.read() will wait for traffic
-        (potentially with a timeout).
+        '''  Reads everything waiting on the connection into the buffer.
+        If nothing is waiting, waits (up to the connection's timeout) 
+        for the first byte instead.
         '''
-        bite = self.connection.read()
+        size = min(max(self.connection.in_waiting, 1), len(self._chunk))
+        count = self.connection.readinto(self._chunk[:size])
         # Make sure it actually returned something
-        # This might be dangerous
-        if not bite:
-            return None
-        else:
-            self.buffer.append(bite)
+        if count:
+            self.buffer.write(self._chunk[:count])
+            if self.capture:
+                self.capture.write(self._chunk[:count])
                 
 
 class PacketDigester(ThreadMonster):
     def __init__(self, packet_generator, input_stream, swallow_trigger=500, 
-                 *args, **kwargs):
+                 frame_sync=None, batch_decoder=None, *args, **kwargs):
+        ''' frame_sync, if given, is called as frame_sync(stream, start) 
+        before each parse and after each bad checksum. It should discard
+        anything that can't start a packet and return the number of 
+        bytes skipped (ex: AimmsPacket.resync). Those are tallied in 
+        skipped_bytes, so time-to-relock can be measured.
+        
+        batch_decoder, if given, replaces packet_generator and 
+        frame_sync: each parse hands it everything buffered, as 
+        batch_decoder(buffer) -> (packets, offset) (ex: 
+        AimmsPacket.decode_many), and queues every packet at once. This
+        requires an input_stream with peek(), ie a ByteRingBuffer.
+        '''
         super().__init__(*args, **kwargs)
         self.input_stream = input_stream
         self.swallow_trigger = swallow_trigger
         self.packet_generator = packet_generator
+        self.frame_sync = frame_sync
+        self.batch_decoder = batch_decoder
         self._output_q = Queue()
+        # Resynchronisation stats
+        self.skipped_bytes = 0
+        self.resyncs = 0
+        # When event driven, how much data to wait for before parsing 
+        # again (ie, more than last time a packet came up short).
+        self._needed = 0
         
+        if self.event_driven:
+            no_faster_than = 0
+        else:
+            no_faster_than = .01
         self.add_thread(task=self.parse, name='packet_digester', 
-                        no_faster_than=.01)
+                        no_faster_than=no_faster_than)
         
     def parse(self):
         ''' Parses data in stream forever, placing the resulting objects in
         the q. Waits for the stream to buffer to stream_buffer bytes before
         parsing.
         '''
+        if self.event_driven:
+            self._wait_for_data()
+            
+        if self.batch_decoder:
+            return self._parse_batch()
+            
         if len(self.input_stream) > self.swallow_trigger:
+            if self.frame_sync:
+                self._resync(0)
             try:
                 packet = self.packet_generator(self.input_stream)
                 self._output_q.put_nowait(packet)
+                self._needed = 0
             # If the packet is too small, break out.
             except PacketSizeError:
+                self._needed = len(self.input_stream) + 1
                 return
             # Catch bad checksums and delete the header. This
             # forces the stream to realign.
             except ChecksumMismatch:
                 print(checksum_warning)
-                del self.input_stream[0]
+                if self.frame_sync:
+                    self._resync(1)
+                else:
+                    del self.input_stream[0]
+                    self.skipped_bytes += 1
                 return
             # except Full:
             
-    def pop(self):
+    def _parse_batch(self):
+        ''' Drains every complete packet in the stream in one go.
+        '''
+        if len(self.input_stream) > self.swallow_trigger:
+            buffered = self.input_stream.peek()
+            packets, offset = self.batch_decoder(buffered)
+            del self.input_stream[0:offset]
+            self._needed = len(buffered) - offset + 1
+            for packet in packets:
+                self._output_q.put_nowait(packet)
+            # Anything consumed but not decoded was skipped.
+            skipped = offset - sum(packet.byte_size for packet in packets)
+            if skipped:
+                self.skipped_bytes += skipped
+                self.resyncs += 1
+            
+    def _wait_for_data(self):
+        ''' Blocks until the stream has grown enough to be worth parsing,
+        or until wait_timeout. Streams without wait_for() are polled.
+        '''
+        needed = max(self.swallow_trigger + 1, self._needed)
+        try:
+            wait_for = self.input_stream.wait_for
+        except AttributeError:
+            time.sleep(.01)
+            return
+        if not wait_for(needed, self.wait_timeout):
+            # Whatever was short last time, don't wait on it forever.
+            self._needed = 0
+            
+    def _resync(self, start):
+        ''' Skips ahead to the next candidate frame, updating stats.
+        '''
+        skipped = self.frame_sync(self.input_stream, start)
+        if skipped:
+            self.skipped_bytes += skipped
+            self.resyncs += 1
+            
+    def pop(self, timeout=None):
         ''' Returns and removes a packet. Threadsafe. Returns None if 
-        no packet is available.
+        no packet is available, after waiting up to timeout seconds for
+        one (if timeout is given).
         '''
         try:
-            return self._output_q.get_nowait()
+            if timeout is None:
+                return self._output_q.get_nowait()
+            return self._output_q.get(timeout=timeout)
         except Empty:
             return None
             
@@ -240,8 +629,89 @@ class SerialDigester(SerialListener, PacketDigester):
         self.input_stream = self.buffer
         
         
+class ReplayDigester(ThreadMonster):
+    def __init__(self, filename, speed=1., queue_size=10000, loop=False, 
+                 *args, **kwargs):
+        ''' Stand-in for SerialDigester that replays a recorded log (see
+        logs.iter_log) instead of listening to a serial port.
+        
+        speed is a multiple of real time (ex: 1 for real time, 10 for 
+        10x), paced off of each record's recorded timestamp. If speed is
+        None or 0, records are replayed as fast as they're popped. At most
+        queue_size records are read ahead. If loop, the log is replayed 
+        over and over; otherwise, finished is set once it runs out.
+        '''
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.speed = speed
+        self.loop = loop
+        self._output_q = Queue(maxsize=queue_size)
+        # Replay stats
+        self.replayed = 0
+        self.finished = Event()
+        self._records = None
+        # (recorded timestamp, monotonic time) of the first record paced
+        self._origin = None
+        
+        self.add_thread(task=self.replay, name='log_replayer', 
+                        no_faster_than=0)
+        
+    def replay(self):
+        ''' Queues the next record from the log, once it's due.
+        '''
+        if self._records is None:
+            self._records = iter_log(self.filename)
+            self._origin = None
+        try:
+            record = next(self._records)
+        except StopIteration:
+            if self.loop:
+                self._records = None
+            else:
+                self.finished.set()
+                self.exit_flag.wait(self.wait_timeout)
+            return
+            
+        timestamp = record.get('timestamp')
+        if self.speed and timestamp is not None:
+            if self._origin is None:
+                self._origin = (timestamp, time.monotonic())
+            due = self._origin[1] + (timestamp - self._origin[0]) / self.speed
+            delay = due - time.monotonic()
+            # Wait on the exit flag, so gaps in the log don't hold up exit.
+            if delay > 0 and self.exit_flag.wait(delay):
+                return
+                
+        # Block while the queue is full, but keep an eye on the exit flag.
+        while not self.exit_flag.is_set():
+            try:
+                self._output_q.put(record, timeout=self.wait_timeout)
+                self.replayed += 1
+                return
+            except Full:
+                pass
+            
+    def pop(self, timeout=None):
+        ''' Returns and removes a record. Threadsafe. Returns None if 
+        no record is available, after waiting up to timeout seconds for
+        one (if timeout is given).
+        '''
+        try:
+            if timeout is None:
+                return self._output_q.get_nowait()
+            return self._output_q.get(timeout=timeout)
+        except Empty:
+            return None
+            
+            
 class StatusServer(ThreadMonster):
-    def __init__(self, port, state_vector, verbose=False, *args, **kwargs):
+    def __init__(self, port, state_vector, verbose=False, streams=None, 
+                 history=None, records=None, *args, **kwargs):
+        ''' streams, if given, maps devices to the PacketBroadcasters 
+        served at /<device>/stream; history, to the TimeSeriesStores 
+        served at /<device>/history; records, to the binary record 
+        packers served at /<device>/binary.
+        '''
         super().__init__(*args, **kwargs)
         self.port = port
         self.state_vector = state_vector
@@ -252,7 +722,8 @@ class StatusServer(ThreadMonster):
             self.handler = QuietRestfulDictHandler
             
         self.server = ThreadedStatefulSocketServer(self.state_vector, 
-            ('', port), self.handler)
+            ('', port), self.handler, streams=streams, history=history,
+            records=records)
         self._threads['status_server'] = \
                 Thread(target=self.server.serve_forever, name='status_server', 
                        args=(), daemon=True)
@@ -262,59 +733,126 @@ class StatusServer(ThreadMonster):
         super().stop()
     
     
-class UAVMaster(ThreadMonster):
-    def __init__(self, aimms_port, http_port, record_to_file=True, 
-                 print_to_terminal=False, *args, **kwargs):
+class PacketSink():
+    ''' Common packet handling for the UAV masters (threaded or asyncio).
+    Keeps the state vector up to date with each ingested packet, 
+    publishes it to self.streams for streaming, keeps the last 
+    history_retention seconds of it in self.history, and optionally 
+    records and prints it. Expects subclasses to provide a self.recorder
+    with a schedule_object() method.
+    '''
+    def __init__(self, record_to_file=True, print_to_terminal=False, 
+                 history_retention=3600., *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.record = record_to_file
         self.print_to_terminal = print_to_terminal
-        
-        # Now let's figure out what to call the output file.
-        fprefix = 'sample_data_'
-        fext = '.txt'
-        fsuffix = 1
-        fname = None
-        while not fname:
-            testname = fprefix + str(fsuffix) + fext
-            if os.path.isfile(testname):
-                fsuffix += 1
-            else:
-                fname = testname
-                
         # Create a state dictionary
-        self.state = {}
+        self.state = StateVector()
+        # Add whatever is needed to the state dictionary
+        self.state['aimms'] = OrderedDict()
+        self.state.touch()
+        # And a packet stream for each device in it
+        self.streams = {'aimms': PacketBroadcaster(
+            encode=lambda obj: json.dumps(obj, default=_to_dict))}
+        # And a history
+        self.history = {'aimms': TimeSeriesStore(history_retention)}
+        
+    def ingest(self, obj):
+        ''' Timestamps, records, and merges a packet into the state.
+        '''
+        # Add secondary unix timestamp
+        obj.update({'timestamp': time.time()})
+        if self.record:
+            self.recorder.schedule_object(obj)
+        # Update state and print it
+        self.state['aimms'].update(obj)
+        self.state['aimms'].update({'_type': 'state'})
+        # Publish it for the readers (ie the status server)
+        self.state.touch('aimms')
+        self.streams['aimms'].publish(obj)
+        self.history['aimms'].append(obj)
+        if self.print_to_terminal:
+            s = json.dumps(self.state['aimms'], indent=4)
+            print(s)
+    
+    
+class UAVMaster(PacketSink, ThreadMonster):
+    def __init__(self, aimms_port, http_port, record_to_file=True, 
+                 print_to_terminal=False, record_raw=False, replay=None, 
+                 replay_speed=1., rotate_bytes=None, rotate_interval=None,
+                 compression=None, *args, **kwargs):
+        ''' If record_raw, the raw serial data is also recorded (see 
+        RawCapture) to sample_data_N.dat, alongside sample_data_N.txt.
+        
+        rotate_bytes, rotate_interval and compression are handed to the
+        FileRecorder; if any is set, the log is written as segments 
+        listed in sample_data_N.manifest instead of sample_data_N.txt.
+        
+        If replay is the filename of a recorded log, it is replayed at
+        replay_speed (see ReplayDigester) instead of reading from 
+        aimms_port, which is then ignored (as is record_raw).
+        '''
+        super().__init__(record_to_file=record_to_file, 
+                         print_to_terminal=print_to_terminal, *args, **kwargs)
+        
+        # Now let's figure out what to call the output file(s).
+        fname = next_filename()
+        if record_raw and not replay:
+            # Pair the capture up with the log.
+            capture = RawCapture(os.path.splitext(fname)[0] + '.dat')
+        else:
+            capture = None
         
         # Create the various UAV components
-        self.aimms = SerialDigester(port=aimms_port, baud=115200,
-                                    packet_generator=AimmsPacket.from_stream)
-        self.recorder = FileRecorder(filename=fname)
+        if replay:
+            self.aimms = ReplayDigester(filename=replay, speed=replay_speed,
+                                        event_driven=self.event_driven,
+                                        wait_timeout=self.wait_timeout)
+        else:
+            self.aimms = SerialDigester(port=aimms_port, baud=115200,
+                                        packet_generator=\
+                                            AimmsPacket.from_stream,
+                                        batch_decoder=AimmsPacket.decode_many,
+                                        # decode_many copes with partial
+                                        # packets, so don't hold any back.
+                                        swallow_trigger=0,
+                                        capture=capture,
+                                        event_driven=self.event_driven,
+                                        wait_timeout=self.wait_timeout)
+        self.recorder = FileRecorder(filename=fname, batch=True,
+                                     rotate_bytes=rotate_bytes,
+                                     rotate_interval=rotate_interval,
+                                     compression=compression,
+                                     event_driven=self.event_driven,
+                                     wait_timeout=self.wait_timeout)
         # Link all of the exit flags so that one exit will induce all others
         self.aimms.exit_flag = self.exit_flag
         self.recorder.exit_flag = self.exit_flag
-        # Add whatever is needed to the state dictionary
-        self.state['aimms'] = OrderedDict()
         
         # Finally add the server
         self.server = StatusServer(http_port, state_vector=self.state, 
-                                   verbose=print_to_terminal)
+                                   verbose=print_to_terminal,
+                                   streams=self.streams,
+                                   history=self.history,
+                                   records={'aimms': pack_state_record})
         
     def run(self):
+        # When event driven, block on the packet queue instead of polling.
+        if self.event_driven:
+            no_faster_than = 0
+            timeout = self.wait_timeout
+        else:
+            no_faster_than = .01
+            timeout = None
+            
         with self, self.aimms, self.recorder, self.server:
-                while True:
-                    with MinimumLoopDelay(.01):
-                        # Get the packet from aimms and possibly record it
-                        obj = self.aimms.pop()
-                        if obj:
-                            # Add secondary unix timestamp
-                            obj.update({'timestamp': time.time()})
-                            if self.record:
-                                self.recorder.schedule_object(obj)
-                            # Update state and print it
-                            self.state['aimms'].update(obj)
-                            self.state['aimms'].update({'_type': 'state'})
-                            if self.print_to_terminal:
-                                s = json.dumps(self.state['aimms'], indent=4)
-                                print(s)
+                while not self.exit_flag.is_set():
+                    with MinimumLoopDelay(no_faster_than):
+                        # Get every packet from aimms and possibly record it
+                        obj = self.aimms.pop(timeout)
+                        while obj:
+                            self.ingest(obj)
+                            obj = self.aimms.pop()
                 
     def stop(self):
         self.aimms.stop()
@@ -0,0 +1,309 @@
+''' Compact in-memory history of ingested packets, for range queries
+
+Every packet type gets its own set of columns: an array('d') of 
+timestamps, and one more per numeric field. Nested fields (ex: the 
+status flags) are flattened into one column per subfield (ex: 
+'status_wind'), just as columnar.py does. Anything older than the 
+retention period is dropped as new packets come in.
+
+Each field is also downsampled as it comes in, into fixed-width time 
+buckets (count, mean, min, max and last value), so that aggregate 
+queries never have to go back over the raw samples.
+'''
+import bisect
+import collections.abc
+import math
+import threading
+from array import array
+from collections import OrderedDict
+
+
+__all__ = ['TimeSeriesStore', 'BucketAggregator']
+
+
+def _flatten(obj, prefix=''):
+    ''' Yields (column, value) for every numeric field in a packet, 
+    flattening any nested ones. Everything else is ignored, as are the
+    timestamp and metadata (ie _-prefixed, ex: _type, _good_checksum).
+    '''
+    for key, value in obj.items():
+        if key == 'timestamp' or key.startswith('_'):
+            continue
+        if isinstance(value, collections.abc.Mapping):
+            yield from _flatten(value, prefix + key + '_')
+        elif isinstance(value, (int, float)):
+            yield prefix + key, value
+            
+            
+class _Series():
+    ''' The columns of a single packet type.
+    '''
+    def __init__(self, fields):
+        self.timestamps = array('d')
+        self.columns = OrderedDict((field, array('d')) for field in fields)
+        # Rows before this have expired, but haven't been deleted yet.
+        self.start = 0
+        
+    def __len__(self):
+        return len(self.timestamps) - self.start
+        
+    def append(self, timestamp, values):
+        self.timestamps.append(timestamp)
+        for field, column in self.columns.items():
+            column.append(values.get(field, math.nan))
+            
+    def expire(self, before):
+        ''' Drops everything timestamped before before. Deleting from 
+        the front of an array is O(n), so that's only actually done once
+        at least half of it has expired.
+        '''
+        self.start = bisect.bisect_left(self.timestamps, before, self.start)
+        if self.start and self.start >= len(self.timestamps) // 2:
+            del self.timestamps[:self.start]
+            for column in self.columns.values():
+                del column[:self.start]
+            self.start = 0
+            
+    def slice(self, since, until):
+        ''' Returns the (start, stop) rows between since and until, 
+        inclusive. Either can be None for unbounded.
+        '''
+        start = self.start
+        stop = len(self.timestamps)
+        if since is not None:
+            start = bisect.bisect_left(self.timestamps, since, start)
+        if until is not None:
+            stop = bisect.bisect_right(self.timestamps, until, start)
+        return start, stop
+        
+        
+class _Buckets():
+    ''' Running aggregates of a single field, in buckets of a fixed 
+    width, as columns.
+    '''
+    def __init__(self, width):
+        self.width = width
+        self.starts = array('d')
+        self.counts = array('d')
+        self.sums = array('d')
+        self.mins = array('d')
+        self.maxes = array('d')
+        self.lasts = array('d')
+        # Buckets before this have expired (see _Series.expire)
+        self.start = 0
+        
+    def _columns(self):
+        return (self.starts, self.counts, self.sums, self.mins, self.maxes,
+                self.lasts)
+        
+    def add(self, timestamp, value):
+        start = math.floor(timestamp / self.width) * self.width
+        if len(self.starts) > self.start and self.starts[-1] == start:
+            self.counts[-1] += 1
+            self.sums[-1] += value
+            if value < self.mins[-1]:
+                self.mins[-1] = value
+            if value > self.maxes[-1]:
+                self.maxes[-1] = value
+            self.lasts[-1] = value
+        else:
+            for column, item in zip(self._columns(), 
+                                    (start, 1, value, value, value, value)):
+                column.append(item)
+                
+    def expire(self, before):
+        # Keep the bucket that before falls in.
+        before = math.floor(before / self.width) * self.width
+        self.start = bisect.bisect_left(self.starts, before, self.start)
+        if self.start and self.start >= len(self.starts) // 2:
+            for column in self._columns():
+                del column[:self.start]
+            self.start = 0
+            
+    def rows(self, since, until, width=None):
+        ''' Yields (start, count, sum, min, max, last) for every bucket 
+        overlapping since to until (either can be None for unbounded), 
+        or rather the whole of the buckets of width (a multiple of 
+        self.width) overlapping it.
+        '''
+        if width is None:
+            width = self.width
+        start = self.start
+        stop = len(self.starts)
+        if since is not None:
+            since = math.floor(since / width) * width
+            start = bisect.bisect_left(self.starts, since, start)
+        if until is not None:
+            until = math.floor(until / width) * width + width
+            stop = bisect.bisect_left(self.starts, until, start)
+        return zip(*(column[start:stop] for column in self._columns()))
+        
+        
+class BucketAggregator():
+    ''' Downsamples every field of every packet type into buckets of 
+    each of widths (in seconds), as packets are added. 
+    
+    Aggregates can be queried at any of those widths, or any whole 
+    multiple of one, by merging its buckets. Not threadsafe on its own
+    (see TimeSeriesStore).
+    '''
+    def __init__(self, widths=(1., 10., 60.), retention=3600.):
+        self.widths = sorted(widths)
+        self.retention = retention
+        # {(packet type, field): [_Buckets for each width]}
+        self._buckets = OrderedDict()
+        
+    def add(self, packet_type, timestamp, values):
+        ''' Adds a packet's (flattened) field values.
+        '''
+        for field, value in values.items():
+            key = (packet_type, field)
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                buckets = [_Buckets(width) for width in self.widths]
+                self._buckets[key] = buckets
+            for bucket in buckets:
+                bucket.add(timestamp, value)
+                if self.retention:
+                    bucket.expire(timestamp - self.retention)
+                    
+    def base_width(self, width):
+        ''' Returns the widest of self.widths that width is a whole 
+        multiple of, or None.
+        '''
+        for base in reversed(self.widths):
+            ratio = width / base
+            if round(ratio) >= 1 and abs(ratio - round(ratio)) < 1e-9:
+                return base
+        return None
+        
+    def query(self, field, width, since=None, until=None):
+        ''' Returns the aggregates of field in buckets of width seconds,
+        from since to until, as an OrderedDict mapping each packet type 
+        with that field to an OrderedDict of lists: 'start' (of each 
+        bucket), 'count', 'mean', 'min', 'max' and 'last'. 
+        
+        Raises ValueError if width isn't a multiple of any of 
+        self.widths.
+        '''
+        base = self.base_width(width)
+        if base is None:
+            raise ValueError('Bucket width must be a multiple of one of ' +
+                             str(self.widths))
+        index = self.widths.index(base)
+        
+        result = OrderedDict()
+        for (packet_type, key), buckets in self._buckets.items():
+            if key != field:
+                continue
+            columns = OrderedDict((name, []) for name in 
+                ('start', 'count', 'mean', 'min', 'max', 'last'))
+            merged = None
+            for row in buckets[index].rows(since, until, width):
+                start = math.floor(row[0] / width) * width
+                if merged and merged[0] == start:
+                    merged[1] += row[1]
+                    merged[2] += row[2]
+                    merged[3] = min(merged[3], row[3])
+                    merged[4] = max(merged[4], row[4])
+                    merged[5] = row[5]
+                else:
+                    if merged:
+                        self._emit(columns, merged)
+                    merged = [start] + list(row[1:])
+            if merged:
+                self._emit(columns, merged)
+            result[packet_type] = columns
+        return result
+        
+    @staticmethod
+    def _emit(columns, row):
+        start, count, total, minimum, maximum, last = row
+        columns['start'].append(start)
+        columns['count'].append(int(count))
+        columns['mean'].append(total / count)
+        columns['min'].append(minimum)
+        columns['max'].append(maximum)
+        columns['last'].append(last)
+        
+        
+class TimeSeriesStore():
+    ''' Keeps the last retention seconds of packets, as columns by 
+    packet type, and answers range queries on them by binary search.
+    
+    Every field is also aggregated into buckets of each of 
+    bucket_widths seconds (see BucketAggregator and aggregate()).
+    
+    Packets must be appended in timestamp order (as they are ingested).
+    Threadsafe, for one writer and any number of readers.
+    '''
+    def __init__(self, retention=3600., bucket_widths=(1., 10., 60.)):
+        self.retention = retention
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self.aggregator = BucketAggregator(bucket_widths, retention)
+        
+    def __len__(self):
+        return sum(len(series) for series in self._series.values())
+        
+    def append(self, obj):
+        ''' Adds a packet (a mapping with '_type' and 'timestamp'). The 
+        columns of each packet type are set by the first packet of it.
+        '''
+        packet_type = obj.get('_type')
+        timestamp = obj.get('timestamp')
+        if packet_type is None or timestamp is None:
+            return
+        values = dict(_flatten(obj))
+        with self._lock:
+            series = self._series.get(packet_type)
+            if series is None:
+                series = _Series(values)
+                self._series[packet_type] = series
+            series.append(timestamp, values)
+            if self.retention:
+                series.expire(timestamp - self.retention)
+            self.aggregator.add(packet_type, timestamp, values)
+                
+    def query(self, since=None, until=None, fields=None):
+        ''' Returns everything from since to until (inclusive; either 
+        can be None for unbounded) as an OrderedDict mapping each packet
+        type to an OrderedDict of lists: 'timestamp', then every field.
+        
+        If fields is given, only those fields are returned, and packet
+        types without any of them are left out altogether. Values a 
+        packet was missing are None.
+        '''
+        result = OrderedDict()
+        with self._lock:
+            for packet_type, series in self._series.items():
+                if fields is None:
+                    selected = list(series.columns)
+                else:
+                    selected = [field for field in fields 
+                                if field in series.columns]
+                    if not selected:
+                        continue
+                start, stop = series.slice(since, until)
+                columns = OrderedDict()
+                columns['timestamp'] = series.timestamps[start:stop]
+                for field in selected:
+                    columns[field] = series.columns[field][start:stop]
+                result[packet_type] = columns
+                
+        # Convert outside of the lock, to hold up the writer no longer
+        # than it takes to copy.
+        for columns in result.values():
+            for field, column in columns.items():
+                column = column.tolist()
+                # NaN isn't valid JSON.
+                columns[field] = [None if value != value else value 
+                                  for value in column]
+        return result
+        
+    def aggregate(self, field, width, since=None, until=None):
+        ''' Returns the aggregates of field in buckets of width seconds.
+        See BucketAggregator.query.
+        '''
+        with self._lock:
+            return self.aggregator.query(field, width, since, until)
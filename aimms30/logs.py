@@ -0,0 +1,264 @@
+''' Reading back the JSON-lines logs written by core.FileRecorder
+
+Logs are one JSON object per line, each carrying the unix 'timestamp' it
+was ingested at. Compressed segments (.gz, .xz) and rotation manifests
+(.manifest) are read transparently.
+'''
+import bisect
+import gzip
+import json
+import lzma
+import mmap
+import os
+import re
+import struct
+from collections import OrderedDict
+
+
+__all__ = ['open_log', 'log_segments', 'iter_log', 'LogReader']
+
+
+# Openers by file extension; anything else is read as plain text.
+_OPENERS = {'.gz': gzip.open,
+            '.xz': lzma.open}
+
+
+def open_log(filename, mode='rt'):
+    ''' Opens a single log file, decompressing it if need be.
+    '''
+    opener = _OPENERS.get(os.path.splitext(filename)[1], open)
+    return opener(filename, mode)
+
+
+def log_segments(filename):
+    ''' Returns the list of files making up a log. For a manifest, that's
+    every segment it lists, in order; otherwise it's just the file.
+    '''
+    if not filename.endswith('.manifest'):
+        return [filename]
+    # Segments always live next to their manifest.
+    directory = os.path.dirname(filename)
+    segments = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                segment = json.loads(line)['segment']
+                segments.append(os.path.join(directory, 
+                                             os.path.basename(segment)))
+    return segments
+
+
+def iter_log(filename):
+    ''' Yields every record in a log (see log_segments) as an OrderedDict,
+    in file order. Lines that don't parse (ex: the last line of a log 
+    whose recorder was killed mid-write) are skipped.
+    '''
+    for segment in log_segments(filename):
+        with open_log(segment) as f:
+            for line in f:
+                try:
+                    yield json.loads(line, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    continue
+
+
+class LogReader():
+    ''' Random access to an uncompressed log by time, without scanning it.
+    
+    The log is memory-mapped, and a sparse index is kept of the first 
+    timestamp at (or after) every stride bytes, which read_range() 
+    bisects to find the only stretch of the log worth reading. Records 
+    are assumed to be in timestamp order, as FileRecorder writes them.
+    
+    The index is cached in a sidecar file (by default, filename + 
+    '.tidx'), and extended rather than rebuilt when the log grows; call
+    refresh() to pick up anything written since opening.
+    '''
+    # Sidecar layout: a header of (stride, indexed bytes), then one 
+    # (timestamp, offset) record per indexed line.
+    INDEX_HEADER = struct.Struct('<QQ')
+    INDEX_RECORD = struct.Struct('<dQ')
+    # Pulls the timestamp out of a line without decoding all of it.
+    _TIMESTAMP = re.compile(rb'"timestamp": ?(-?[0-9][0-9.eE+-]*)')
+    
+    def __init__(self, filename, stride=65536, index_filename=None):
+        if os.path.splitext(filename)[1] in _OPENERS:
+            raise ValueError('Compressed logs cannot be memory-mapped: ' + 
+                             filename)
+        self.filename = filename
+        self.stride = stride
+        if index_filename is None:
+            index_filename = filename + '.tidx'
+        self.index_filename = index_filename
+        self._f = None
+        self._mm = None
+        self._times = []
+        self._offsets = []
+        # Everything before this has been indexed.
+        self._indexed = 0
+        self._load_index()
+        self.refresh()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args, **kwargs):
+        self.close()
+        
+    def __len__(self):
+        ''' Size of the mapped log, in bytes.
+        '''
+        if self._mm is None:
+            return 0
+        return len(self._mm)
+        
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._f:
+            self._f.close()
+            self._f = None
+            
+    def refresh(self):
+        ''' Remaps the log, indexing anything new since last time.
+        '''
+        self.close()
+        size = os.path.getsize(self.filename)
+        # Truncated or replaced logs invalidate the whole index.
+        if size < self._indexed:
+            self._reset_index()
+        # Empty files can't be mapped.
+        if size:
+            self._f = open(self.filename, 'rb')
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._extend_index():
+            self._save_index()
+            
+    def _reset_index(self):
+        self._times = []
+        self._offsets = []
+        self._indexed = 0
+        
+    def _load_index(self):
+        try:
+            with open(self.index_filename, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        header_size = self.INDEX_HEADER.size
+        if len(data) < header_size:
+            return
+        stride, indexed = self.INDEX_HEADER.unpack_from(data)
+        if stride != self.stride:
+            return
+        records = self.INDEX_RECORD.iter_unpack(
+            data[header_size:len(data) - 
+                 (len(data) - header_size) % self.INDEX_RECORD.size])
+        for timestamp, offset in records:
+            self._times.append(timestamp)
+            self._offsets.append(offset)
+        self._indexed = indexed
+        
+    def _save_index(self):
+        with open(self.index_filename, 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.stride, self._indexed))
+            f.writelines(self.INDEX_RECORD.pack(timestamp, offset) 
+                         for timestamp, offset in zip(self._times, 
+                                                      self._offsets))
+            
+    def _extend_index(self):
+        ''' Indexes the first timestamped line at or after each stride 
+        boundary not indexed yet. Stops short of any incomplete line.
+        Returns True if anything changed.
+        '''
+        mm = self._mm
+        if mm is None:
+            return False
+        size = len(mm)
+        start = self._indexed
+        changed = False
+        while start < size:
+            # Find the start of the first full line at or after start.
+            if start:
+                newline = mm.find(b'\n', start - 1)
+                if newline < 0:
+                    break
+                start = newline + 1
+            # Then the first of those with a timestamp.
+            line_start = start
+            line_end = -1
+            timestamp = None
+            while line_start < size:
+                line_end = mm.find(b'\n', line_start)
+                if line_end < 0:
+                    break
+                timestamp = self._timestamp(mm[line_start:line_end])
+                if timestamp is not None:
+                    break
+                line_start = line_end + 1
+            if line_end < 0 or line_start >= size:
+                break
+            if not self._offsets or line_start > self._offsets[-1]:
+                self._times.append(timestamp)
+                self._offsets.append(line_start)
+            # On to the next boundary past this line.
+            start = (line_end // self.stride + 1) * self.stride
+            self._indexed = min(start, size)
+            changed = True
+        return changed
+    
+    @classmethod
+    def _timestamp(cls, line):
+        match = cls._TIMESTAMP.search(line)
+        if match:
+            try:
+                return float(match.group(1))
+            except ValueError:
+                return None
+        return None
+        
+    def _bounds(self, t0, t1):
+        ''' Returns the byte range guaranteed to hold every record from
+        t0 to t1.
+        '''
+        # Start from the last entry strictly before t0, since ties may 
+        # stretch back past an entry equal to it.
+        index = max(bisect.bisect_left(self._times, t0) - 1, 0)
+        start = self._offsets[index] if self._offsets else 0
+        index = bisect.bisect_right(self._times, t1)
+        if index < len(self._offsets):
+            end = self._offsets[index]
+        else:
+            end = len(self)
+        return start, end
+        
+    def iter_range(self, t0, t1):
+        ''' Yields every record timestamped from t0 to t1 (inclusive) as
+        an OrderedDict, in file order.
+        '''
+        if self._mm is None:
+            return
+        start, end = self._bounds(t0, t1)
+        for line in self._mm[start:end].splitlines():
+            timestamp = self._timestamp(line)
+            if timestamp is None or timestamp < t0:
+                continue
+            if timestamp > t1:
+                break
+            try:
+                yield json.loads(line.decode(), object_pairs_hook=OrderedDict)
+            except ValueError:
+                continue
+            
+    def read_range(self, t0, t1):
+        ''' Returns a list of every record timestamped from t0 to t1 
+        (inclusive). See iter_range.
+        '''
+        return list(self.iter_range(t0, t1))
+        
+    @property
+    def start_time(self):
+        ''' Timestamp of the first indexed record, or None.
+        '''
+        return self._times[0] if self._times else None
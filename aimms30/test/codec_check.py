@@ -0,0 +1,184 @@
+''' Round-trip check for the packet decoders.
+
+Builds met, position, purge and temp frames by hand, then makes sure
+every way of decoding them (Packet, Packet.from_stream on a SliceDeque
+and on a ByteRingBuffer, Packet.decode_many and PacketView) agrees on
+the expected values. Run it from this directory:
+
+    python codec_check.py
+'''
+import sys
+sys.path.append('../../')
+import aimms30
+import struct
+from collections import OrderedDict
+from aimms30.utils import SliceDeque
+from aimms30.utils import ByteRingBuffer
+
+
+def frame(packet_id, body):
+    ''' Wraps a packed body in a header and checksum footer.
+    '''
+    header = bytes([1, packet_id, 255 - packet_id, len(body)])
+    checksum = sum(header + body)
+    return header + body + struct.pack('<H', checksum)
+    
+    
+def close_enough(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        return abs(a - b) <= 1e-9 * max(1, abs(a), abs(b))
+    return a == b
+    
+    
+def check(packet, expected):
+    ''' Compares a decoded packet (or its to_dict()) to the expected 
+    values, field by field and in order.
+    '''
+    assert list(packet.keys()) == list(expected.keys()), \
+        (list(packet.keys()), list(expected.keys()))
+    for key, value in expected.items():
+        assert close_enough(packet[key], value), (key, packet[key], value)
+        
+        
+MET = frame(0, struct.pack('<BBBhHHhhhHB', 12, 34, 56, 2762, 384, 50616, 
+                           -150, 275, 312, 9000, 0b101))
+MET_EXPECTED = [
+    ('_type', 'met'),
+    ('_good_checksum', True),
+    ('utc_hours', 12),
+    ('utc_minutes', 34),
+    ('utc_seconds', 56),
+    ('temperature', 27.62),
+    ('rh', .384),
+    ('pressure', 101232.),
+    ('wind_vector_north', -1.5),
+    ('wind_vector_east', 2.75),
+    ('wind_speed', 3.12),
+    ('wind_direction', 90.),
+    ('status', {'wind': True, 'purge': False, 'gps': True}),
+    ]
+
+POSITION = frame(1, struct.pack('<BBBffhhhhhhhhhhhh', 12, 34, 57, 37.5, 
+                                -122.25, 6, 100, -250, 5, 1234, -567, 9000,
+                                2500, -30, 45, 1234, -5678))
+POSITION_EXPECTED = [
+    ('_type', 'position'),
+    ('_good_checksum', True),
+    ('utc_hours', 12),
+    ('utc_minutes', 34),
+    ('utc_seconds', 57),
+    ('latitude', 37.5),
+    ('longitude', -122.25),
+    ('altitude', 6),
+    ('velocity_north', 1.),
+    ('velocity_east', -2.5),
+    ('velocity_down', .05),
+    ('roll', 12.34),
+    ('pitch', -5.67),
+    ('yaw', 180.),
+    ('airspeed', 25.),
+    ('wind_vertical', -.3),
+    ('sideslip', .45),
+    ('aoa_differential', .1234),
+    ('sideslip_differential', -.5678),
+    ]
+
+# Flow is signed.
+PURGE = frame(4, struct.pack('<h', -42))
+PURGE_EXPECTED = [
+    ('_type', 'purge'),
+    ('_good_checksum', True),
+    ('flow', -42),
+    ]
+
+TEMP = frame(5, struct.pack('<hhh', 300, -20, 150))
+TEMP_EXPECTED = [
+    ('_type', 'temp'),
+    ('_good_checksum', True),
+    ('forward', 300),
+    ('aft', -20),
+    ('threshold', 150),
+    ]
+
+FRAMES = [MET, POSITION, PURGE, TEMP]
+EXPECTED = [OrderedDict(pairs) for pairs in (MET_EXPECTED, POSITION_EXPECTED, 
+                                              PURGE_EXPECTED, TEMP_EXPECTED)]
+
+# A bad checksum, to be skipped over.
+BAD = bytearray(TEMP)
+BAD[-1] ^= 0xff
+BAD = bytes(BAD)
+# Junk up front (including a fake SOH), then every frame, a bad frame, 
+# and finally half a frame.
+STREAM = b'\x00\x01\x07' + b''.join(FRAMES) + BAD + b''.join(FRAMES) + \
+    MET[:10]
+    
+    
+# Packet, one frame at a time
+for data, expected in zip(FRAMES, EXPECTED):
+    packet = aimms30.Packet(data)
+    check(packet, expected)
+    assert packet.byte_size == len(data)
+    assert packet.packet_type == expected['_type']
+try:
+    aimms30.Packet(BAD)
+    raise AssertionError('Bad checksum not caught.')
+except aimms30.ChecksumMismatch:
+    pass
+try:
+    aimms30.Packet(MET[:10])
+    raise AssertionError('Partial packet not caught.')
+except aimms30.PacketSizeError:
+    pass
+print('Packet: OK')
+
+
+def drain(stream):
+    ''' Pulls every packet out of a stream with from_stream, skipping 
+    the bad one like PacketDigester would.
+    '''
+    packets = []
+    while True:
+        try:
+            packets.append(aimms30.Packet.from_stream(stream))
+        except aimms30.ChecksumMismatch:
+            del stream[0]
+        except aimms30.PacketSizeError:
+            return packets
+            
+
+# from_stream, on both kinds of stream
+deque_stream = SliceDeque()
+for bite in STREAM:
+    deque_stream.append(bite.to_bytes(1, 'big'))
+ring_stream = ByteRingBuffer(capacity=16)
+ring_stream.write(STREAM)
+for name, stream in (('SliceDeque', deque_stream), 
+                     ('ByteRingBuffer', ring_stream)):
+    packets = drain(stream)
+    assert len(packets) == 2 * len(FRAMES), (name, len(packets))
+    for packet, expected in zip(packets, EXPECTED + EXPECTED):
+        check(packet, expected)
+    # Only the partial frame is left.
+    assert len(stream) == 10, (name, len(stream))
+    print('from_stream on ' + name + ': OK')
+
+
+# decode_many, eager and lazy
+packets, offset = aimms30.Packet.decode_many(STREAM)
+assert len(packets) == 2 * len(FRAMES)
+assert offset == len(STREAM) - 10
+for packet, expected in zip(packets, EXPECTED + EXPECTED):
+    check(packet, expected)
+print('decode_many: OK')
+
+views, offset = aimms30.Packet.decode_many(STREAM, lazy=True)
+assert offset == len(STREAM) - 10
+assert len(views) == len(packets)
+for view, packet, expected in zip(views, packets, EXPECTED + EXPECTED):
+    assert isinstance(view, aimms30.PacketView)
+    check(view, expected)
+    check(view.to_dict(), expected)
+    assert view.to_dict() == packet
+    assert view.raw == packet._raw
+print('decode_many (lazy) and PacketView.to_dict(): OK')
@@ -0,0 +1,104 @@
+''' Check that state streams can't hold on to a worker forever.
+
+Starts a status server on localhost, then makes sure that out of range
+?rate= values are refused with a 400, and that a stream at the highest
+rate allowed gives its slot back once the client goes away, even though
+the state never changes (so that only the keepalives can notice). Run
+it from this directory:
+
+    python stream_check.py
+'''
+import sys
+sys.path.append('../../')
+import http.client
+import socket
+import threading
+import time
+from aimms30.utils import PacketBroadcaster
+from aimms30.utils import QuietRestfulDictHandler
+from aimms30.utils import StateVector
+from aimms30.utils import ThreadedStatefulSocketServer
+
+
+class Handler(QuietRestfulDictHandler):
+    # Don't wait 15 seconds for every dead client.
+    stream_keepalive = .5
+
+
+def status(port, path):
+    connection = http.client.HTTPConnection('localhost', port, timeout=5)
+    connection.request('GET', path)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def open_stream(port, path):
+    ''' Starts streaming path, and returns the socket once the headers
+    have come back.
+    '''
+    sock = socket.create_connection(('localhost', port), timeout=5)
+    sock.sendall(b'GET ' + path.encode() + b' HTTP/1.1\r\n'
+                 b'Host: localhost\r\n\r\n')
+    received = b''
+    while b'\r\n\r\n' not in received:
+        received += sock.recv(4096)
+    assert received.startswith(b'HTTP/1.1 200'), received
+    return sock
+
+
+def free_slots(server):
+    ''' Counts the stream slots that can be taken right now (giving them
+    straight back).
+    '''
+    taken = 0
+    while server.stream_slots.acquire(blocking=False):
+        taken += 1
+    for __ in range(taken):
+        server.stream_slots.release()
+    return taken
+    
+    
+def wait_for_slots(server, timeout):
+    ''' Waits for every stream slot to be given back.
+    '''
+    deadline = time.monotonic() + timeout
+    while free_slots(server) < server.max_streams:
+        assert time.monotonic() < deadline, 'Stream slots never released'
+        time.sleep(.1)
+
+
+if __name__ == '__main__':
+    state = StateVector(aimms={'tas': 1.})
+    server = ThreadedStatefulSocketServer(
+        state, ('localhost', 0), Handler,
+        streams={'aimms': PacketBroadcaster()})
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Out of range rates are refused before they take a slot.
+    for rate in ('0', '-1', '1e9', '51', 'inf', 'nan', 'fast'):
+        code = status(port, '/aimms/stream?rate=' + rate)
+        assert code == 400, (rate, code)
+    assert free_slots(server) == server.max_streams
+    print('Out of range rates: OK')
+
+    # Very slow rates are fine too (they used to overflow the wait).
+    sock = open_stream(port, '/aimms/stream?rate=1e-300')
+    sock.close()
+    wait_for_slots(server, 5 * Handler.stream_keepalive + 2)
+    print('Slow stream released after the client went away: OK')
+
+    # Fill every slot with the fastest streams allowed, then hang up.
+    socks = [open_stream(port, '/aimms/stream?rate={}'.format(
+                 Handler.max_stream_rate))
+             for __ in range(server.max_streams)]
+    time.sleep(.2)
+    assert free_slots(server) == 0
+    for sock in socks:
+        sock.close()
+    wait_for_slots(server, 5 * Handler.stream_keepalive + 2)
+    print('Slots released after the clients went away: OK')
+
+    server.shutdown()
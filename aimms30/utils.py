@@ -1,19 +1,308 @@
 import threading
 import collections
+import collections.abc
 import itertools
 import time
 import http.server
 import tempfile
 import urllib
+import urllib.parse
 import posixpath
 import mimetypes
 import json
+import zlib
+import email.utils
+import math
+import datetime
 from http.server import HTTPServer
-from socketserver import ThreadingMixIn
+import queue
 import os
 import shutil
 
 
+def resolve_path(state, path):
+    ''' Walks a RESTful /a/b/c path down into a nested state dict, 
+    returning the value there. Raises KeyError if there is none.
+    '''
+    # Don't forget to strip the original '/' to avoid having an empty
+    # string at the beginning of the path string.
+    for key in path.strip('/').split('/'):
+        # Check to make sure there was a string
+        if not key:
+            break
+        # Mutate state until we divide it into the desired key
+        try:
+            state = state[key]
+        except (KeyError, TypeError, IndexError):
+            raise KeyError(path)
+    return state
+
+
+# An immutable, published version of a StateVector.
+Snapshot = collections.namedtuple('Snapshot', ['version', 'published', 
+                                               'state'])
+
+
+def _snapshot_copy(value):
+    ''' Deep-copies the containers in value, so that later changes to
+    the original never show through.
+    '''
+    if isinstance(value, collections.abc.Mapping):
+        return {key: _snapshot_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_snapshot_copy(item) for item in value]
+    return value
+
+
+class StateVector(dict):
+    ''' A state dict with a single writer and any number of readers.
+    
+    The writer mutates it in place, then calls touch() to publish a 
+    copy of it as the next Snapshot. Readers only ever use snapshot(),
+    which never blocks and is never modified after it's published, so
+    whatever they read is consistent. Snapshots are copy-on-write: only
+    the top-level keys passed to touch() are copied again, and the rest
+    are shared with the previous snapshot.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._snapshot = Snapshot(0, time.time(), _snapshot_copy(self))
+        
+    @property
+    def version(self):
+        return self._snapshot.version
+        
+    def touch(self, *keys):
+        ''' Publishes the state as a new snapshot. If keys are given,
+        only those have changed since the last one.
+        '''
+        previous = self._snapshot
+        if keys:
+            state = dict(previous.state)
+            for key in keys:
+                if key in self:
+                    state[key] = _snapshot_copy(self[key])
+                else:
+                    state.pop(key, None)
+        else:
+            state = _snapshot_copy(self)
+        # Swapping the reference is atomic; readers see old or new.
+        self._snapshot = Snapshot(previous.version + 1, time.time(), state)
+        
+    def snapshot(self):
+        ''' Returns the latest published Snapshot. Threadsafe.
+        '''
+        return self._snapshot
+        
+        
+def resolve_request(state, request_path):
+    ''' Resolves a request path, including its query, against a state 
+    dict (see resolve_path). Raises KeyError if there's nothing there.
+    
+    Two queries are understood, and may be combined:
+    
+    /batch?path=/a/b,/c/d returns a dict of each path (which may also 
+    be given as repeated path= parameters) to its value, or None if 
+    there's nothing there.
+    
+    /a?fields=b,c/d projects the value at /a down to a dict of just 
+    those (sub)paths within it, again None if there's nothing there.
+    '''
+    path, _, query = request_path.partition('?')
+    query = urllib.parse.parse_qs(query)
+    fields = _query_list(query, 'fields')
+    
+    if path.strip('/') == 'batch':
+        paths = _query_list(query, 'path') or []
+        result = collections.OrderedDict()
+        for path in paths:
+            try:
+                result[path] = _project(resolve_path(state, path), fields)
+            except KeyError:
+                result[path] = None
+        return result
+        
+    return _project(resolve_path(state, path), fields)
+    
+    
+def _project(value, fields):
+    ''' Projects value down to fields (see resolve_request), if any.
+    '''
+    if fields is None:
+        return value
+    projected = collections.OrderedDict()
+    for field in fields:
+        try:
+            projected[field] = resolve_path(value, field)
+        except KeyError:
+            projected[field] = None
+    return projected
+
+
+def accepted_encoding(accept_encoding, supported=('gzip', 'deflate')):
+    ''' Returns the supported content coding most preferred by an 
+    Accept-Encoding header (ties going to the first supported), or None
+    for no coding at all.
+    '''
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.
+        qualities[coding.strip().lower()] = quality
+        
+    best = None
+    best_quality = 0.
+    for coding in supported:
+        quality = qualities.get(coding, qualities.get('*', 0.))
+        if quality > best_quality:
+            best = coding
+            best_quality = quality
+    return best
+    
+    
+def compress_body(body, encoding):
+    ''' Compresses body with a content coding: 'gzip' or 'deflate' (which,
+    in HTTP, means zlib-wrapped deflate).
+    '''
+    # The window bits pick the wrapper; 16 + 15 is gzip (without a 
+    # timestamp, so the same body always compresses the same).
+    wbits = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits[encoding])
+    return compressor.compress(body) + compressor.flush()
+
+
+class Subscription():
+    ''' One subscriber's view of a PacketBroadcaster: a bounded buffer 
+    that drops its oldest items once full, counting how many it drops.
+    '''
+    def __init__(self, maxlen):
+        self._items = collections.deque(maxlen=maxlen)
+        self._ready = threading.Condition()
+        self.dropped = 0
+        
+    def __len__(self):
+        return len(self._items)
+        
+    def put(self, item):
+        with self._ready:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._ready.notify()
+            
+    def get(self, timeout=None):
+        ''' Waits up to timeout seconds for anything to arrive, then 
+        returns (items, dropped): everything buffered, and how many 
+        items were dropped since the last get.
+        '''
+        with self._ready:
+            if not self._items:
+                self._ready.wait(timeout)
+            items = list(self._items)
+            self._items.clear()
+            dropped, self.dropped = self.dropped, 0
+        return items, dropped
+        
+        
+class PacketBroadcaster():
+    ''' Fans published objects out to any number of Subscriptions. 
+    
+    Objects are encoded (by default, with json.dumps) once, and only if
+    anyone is subscribed, so publishing to nobody is nearly free. 
+    Publishing never blocks on a slow subscriber; it just overflows.
+    '''
+    def __init__(self, maxlen=256, encode=json.dumps):
+        self.maxlen = maxlen
+        self.encode = encode
+        # Replaced (never mutated) on (un)subscribe, so publish needs no
+        # lock.
+        self._subscribers = frozenset()
+        self._lock = threading.Lock()
+        
+    def __len__(self):
+        return len(self._subscribers)
+        
+    def subscribe(self, maxlen=None):
+        ''' Returns a new Subscription, buffering up to maxlen items (by
+        default, self.maxlen). Threadsafe.
+        '''
+        subscription = Subscription(maxlen or self.maxlen)
+        with self._lock:
+            self._subscribers = self._subscribers | {subscription}
+        return subscription
+        
+    def unsubscribe(self, subscription):
+        ''' Threadsafe. '''
+        with self._lock:
+            self._subscribers = self._subscribers - {subscription}
+            
+    def publish(self, obj):
+        subscribers = self._subscribers
+        if not subscribers:
+            return
+        item = self.encode(obj)
+        for subscription in subscribers:
+            subscription.put(item)
+        
+        
+def _query_float(query, key):
+    ''' Returns a float parameter from a parse_qs query, or None if it's
+    not there. Raises ValueError if it's not a finite number.
+    '''
+    try:
+        value = float(query[key][0])
+    except KeyError:
+        return None
+    # Otherwise, inf overflows (and nan slips through) further down.
+    if not math.isfinite(value):
+        raise ValueError(value)
+    return value
+        
+        
+# Duration suffixes, in seconds
+_DURATION_UNITS = {'ms': .001, 's': 1., 'm': 60., 'h': 3600.}
+
+
+def _query_duration(query, key):
+    ''' Returns a duration parameter (ex: 500ms, 1s, 5m, or just seconds)
+    from a parse_qs query in seconds, or None if it's not there. Raises 
+    ValueError if it's not a positive, finite duration.
+    '''
+    try:
+        value = query[key][0].strip()
+    except KeyError:
+        return None
+    scale = 1.
+    for unit in ('ms', 's', 'm', 'h'):
+        if value.endswith(unit):
+            value = value[:-len(unit)]
+            scale = _DURATION_UNITS[unit]
+            break
+    duration = float(value) * scale
+    if not (duration > 0 and math.isfinite(duration)):
+        raise ValueError(value)
+    return duration
+
+
+def _query_list(query, key):
+    ''' Returns a comma-separated (and/or repeated) parameter from a 
+    parse_qs query as a list, or None if it's not there.
+    '''
+    if key not in query:
+        return None
+    return [item for value in query[key] for item in value.split(',') 
+            if item]
+
+
 class ParsingError(RuntimeError):
     ''' Very likely to indicate misaligned packet frames.
     '''
@@ -199,16 +488,331 @@ class SliceDeque(collections.deque):
         return value
       
       
-class ThreadedStatefulSocketServer(ThreadingMixIn, HTTPServer):
+class ByteRingBuffer():
+    ''' Byte FIFO backed by a single preallocated bytearray. 
+    
+    Intended for one writer thread and one reader thread, ex: between a 
+    SerialListener and a PacketDigester. Unlike a SliceDeque, data is 
+    stored contiguously (1 byte per byte), writes are bulk copies, and 
+    the lock is taken once per call instead of once per byte.
+    
+    peek() returns a zero-copy memoryview of buffered data, except when
+    the data wraps around the end of the ring, in which case it returns
+    a copy. The view is only valid until those bytes are consume()d.
+    consume() just moves the read index. If a write would overflow, the
+    ring grows; views already handed out keep referencing the old 
+    storage, so they stay valid.
+    
+    Also supports len(), slicing and deletes from the front, so that it
+    can be used directly as a PacketDigester input_stream, and wait_for()
+    so that the reader can block until data arrives.
+    '''
+    def __init__(self, capacity=65536):
+        self._data = bytearray(capacity)
+        self._view = memoryview(self._data)
+        # Read index and amount of buffered data.
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        # Signalled on every write.
+        self._written = threading.Condition(self._lock)
+        
+    def __len__(self):
+        return self._size
+        
+    @property
+    def capacity(self):
+        return len(self._data)
+        
+    def write(self, data):
+        ''' Appends the contents of a bytes-like object to the buffer,
+        returning the number of bytes written. Threadsafe.
+        '''
+        data = memoryview(data).cast('B')
+        count = len(data)
+        with self._lock:
+            if self._size + count > len(self._data):
+                self._grow(self._size + count)
+            capacity = len(self._data)
+            tail = (self._head + self._size) % capacity
+            # Write up to the end of the ring, then wrap around.
+            first = min(count, capacity - tail)
+            self._view[tail:tail + first] = data[:first]
+            if first < count:
+                self._view[0:count - first] = data[first:]
+            self._size += count
+            self._written.notify_all()
+        return count
+        
+    def wait_for(self, size, timeout=None):
+        ''' Blocks until at least size bytes are buffered, or until 
+        timeout. Returns whether or not they are. Threadsafe.
+        '''
+        with self._written:
+            return self._written.wait_for(lambda: self._size >= size, 
+                                          timeout)
+        
+    def peek(self, size=None):
+        ''' Returns up to size bytes from the front of the buffer (or 
+        everything, if size is None) without consuming them. Threadsafe.
+        '''
+        with self._lock:
+            if size is None or size > self._size:
+                size = self._size
+            capacity = len(self._data)
+            end = self._head + size
+            if end <= capacity:
+                return self._view[self._head:end]
+            # Wrapped around; can't be zero-copy.
+            return bytes(self._view[self._head:]) + \
+                bytes(self._view[0:end - capacity])
+        
+    def consume(self, size):
+        ''' Discards size bytes from the front of the buffer. Threadsafe.
+        '''
+        with self._lock:
+            if size < 0 or size > self._size:
+                raise IndexError('Cannot consume more than is buffered.')
+            self._size -= size
+            # Rewind when empty, to keep future peeks contiguous.
+            if self._size:
+                self._head = (self._head + size) % len(self._data)
+            else:
+                self._head = 0
+                
+    def clear(self):
+        with self._lock:
+            self._head = 0
+            self._size = 0
+        
+    def __getitem__(self, index):
+        ''' Returns a copy of the indexed byte(s), exactly as bytes would.
+        '''
+        if isinstance(index, slice) and not index.start and \
+            index.step in (None, 1) and \
+            index.stop is not None and index.stop >= 0:
+                return bytes(self.peek(index.stop))
+        return bytes(self.peek())[index]
+        
+    def __delitem__(self, index):
+        ''' Implements deletes, but only from the front of the buffer.
+        '''
+        if isinstance(index, slice):
+            if index.start or index.step not in (None, 1):
+                raise IndexError('Can only delete from the front.')
+            if index.stop is None:
+                self.consume(self._size)
+            else:
+                self.consume(index.stop)
+        elif index == 0:
+            self.consume(1)
+        else:
+            raise IndexError('Can only delete from the front.')
+            
+    def _grow(self, needed):
+        ''' Replaces the storage with a larger one. IS NOT PUBLIC; IS NOT
+        THREADSAFE unless used within another blocking function.
+        '''
+        capacity = max(2 * len(self._data), needed)
+        data = bytearray(capacity)
+        # Linearize while copying.
+        first = min(self._size, len(self._data) - self._head)
+        data[0:first] = self._view[self._head:self._head + first]
+        data[first:self._size] = self._view[0:self._size - first]
+        self._data = data
+        self._view = memoryview(data)
+        self._head = 0
+      
+      
+class WorkerPoolMixIn():
+    ''' Like socketserver.ThreadingMixIn, but handles connections on a 
+    fixed pool of worker threads, so that a burst of clients can't 
+    spawn a burst of threads (all competing for the GIL with whatever 
+    else the process is doing, ex: reading a serial port).
+    
+    Accepted connections wait in a queue for up to backlog connections;
+    past that, they're shed with a 503 straight away.
+    '''
+    workers = 8
+    backlog = 16
+    # The listen() backlog, before connections are even accepted.
+    request_queue_size = 16
+    
+    shed_response = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                     b'Content-Length: 0\r\n'
+                     b'Retry-After: 1\r\n'
+                     b'Connection: close\r\n\r\n')
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shed = 0
+        self._requests = queue.Queue(maxsize=self.backlog)
+        self._workers = []
+        self._stopping = False
+        for index in range(self.workers):
+            worker = threading.Thread(target=self._work, daemon=True,
+                                      name='http_worker_' + str(index))
+            worker.start()
+            self._workers.append(worker)
+            
+    def busy(self):
+        ''' Returns True if connections are waiting on a worker.
+        '''
+        return not self._requests.empty()
+        
+    def process_request(self, request, client_address):
+        ''' Queues a connection for the pool, or sheds it if the queue 
+        is full.
+        '''
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            self.shed += 1
+            try:
+                request.settimeout(1.)
+                request.sendall(self.shed_response)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            # Sentinel, from stop_workers
+            if request is None:
+                return
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                
+    def stop_workers(self):
+        ''' Drops any waiting connections, and stops the workers once 
+        they finish their current ones.
+        '''
+        if self._stopping:
+            return
+        self._stopping = True
+        try:
+            while True:
+                request, client_address = self._requests.get_nowait()
+                if request is not None:
+                    self.shutdown_request(request)
+        except queue.Empty:
+            pass
+        for worker in self._workers:
+            self._requests.put((None, None))
+            
+    def server_close(self):
+        super().server_close()
+        self.stop_workers()
+            
+
+class ThreadedStatefulSocketServer(WorkerPoolMixIn, HTTPServer):
+    ''' Serves a state vector (see RestfulDictHandler) from a pool of
+    worker threads. At most max_streams of those will be streaming at
+    once, so there's always a worker left for everyone else.
+    '''
     allow_reuse_address = True
+    max_streams = 4
     
-    def __init__(self, state_vector, *args, **kwargs):
+    def __init__(self, state_vector, *args, streams=None, history=None, 
+                 records=None, **kwargs):
+        ''' streams, if given, maps devices (ie top-level state keys) to
+        the PacketBroadcasters that handlers stream from (see 
+        RestfulDictHandler.send_stream). Likewise, history maps them to
+        their TimeSeriesStores (see RestfulDictHandler.send_history), 
+        and records to functions packing their state into binary 
+        records, as records[device](state, version) -> bytes (see
+        RestfulDictHandler.send_record).
+        '''
         self.state_vector = state_vector
+        if streams is None:
+            streams = {}
+        self.streams = streams
+        if history is None:
+            history = {}
+        self.history = history
+        if records is None:
+            records = {}
+        self.records = records
+        # Tells streaming handlers to finish up.
+        self.closing = threading.Event()
+        self.stream_slots = threading.BoundedSemaphore(self.max_streams)
+        # (state version, {path: serialized body})
+        self._body_cache = (None, {})
+        # Versions restart with the server, so tell ETags apart by when
+        # it started.
+        self.epoch = '{:x}'.format(int(time.time() * 1000))
         super().__init__(*args, **kwargs)
+        
+    def snapshot(self):
+        ''' Returns the latest Snapshot of the state. Plain dicts can't
+        be snapshotted, so they're served live, without a version.
+        '''
+        try:
+            return self.state_vector.snapshot()
+        except AttributeError:
+            return Snapshot(None, None, self.state_vector)
+        
+    def serialize(self, path, snapshot=None, encoding=None):
+        ''' Returns the JSON body for the request path within snapshot 
+        (by default, the latest one) as bytes, compressed with encoding
+        if given (see compress_body). Each path is only serialized (and
+        compressed) once per version. Raises KeyError if there's nothing
+        at path. See resolve_request for the queries it understands.
+        '''
+        if snapshot is None:
+            snapshot = self.snapshot()
+        if encoding:
+            build = lambda: compress_body(self.serialize(path, snapshot), 
+                                          encoding)
+        else:
+            build = lambda: json.dumps(
+                resolve_request(snapshot.state, path)).encode()
+        return self._cached((path, encoding), snapshot, build)
+        
+    def pack_record(self, device, snapshot=None):
+        ''' Returns the binary record of a device's state within 
+        snapshot (by default, the latest one), packing it only once per
+        version. Raises KeyError if the device has no record format.
+        '''
+        if snapshot is None:
+            snapshot = self.snapshot()
+        pack = self.records[device]
+        build = lambda: pack(snapshot.state.get(device, {}), 
+                             snapshot.version)
+        return self._cached((device, 'record'), snapshot, build)
+        
+    def _cached(self, key, snapshot, build):
+        ''' Returns the body cached under key for snapshot's version, 
+        calling build() to make it if there isn't one yet.
+        '''
+        version = snapshot.version
+        cached_version, bodies = self._body_cache
+        if version is None:
+            bodies = {}
+        # Swap in a fresh cache (atomically) whenever the state changes,
+        # but don't let a straggling old snapshot replace a newer one.
+        elif version != cached_version:
+            bodies = {}
+            if cached_version is None or version > cached_version:
+                self._body_cache = (version, bodies)
+        try:
+            return bodies[key]
+        except KeyError:
+            pass
+        body = build()
+        bodies[key] = body
+        return body
     
     def shutdown(self):
+        self.closing.set()
         self.socket.close()
         super().shutdown()
+        self.stop_workers()
         
 
 class RestfulDictHandler(http.server.BaseHTTPRequestHandler):
@@ -225,79 +829,384 @@ class RestfulDictHandler(http.server.BaseHTTPRequestHandler):
 
     __version__ = '0.0.1'
     server_version = "RestfulDictHandler/" + __version__
+    
+    # Keep connections alive between requests (every response is 
+    # framed by Content-Length), closing them after timeout idle 
+    # seconds, or once they've served max_requests. Idle connections
+    # still tie up a worker, so don't wait on them for long.
+    protocol_version = "HTTP/1.1"
+    timeout = 5.
+    max_requests = 1000
+    # Responses are small and come in two writes (headers, then body),
+    # so don't let Nagle hold the body back.
+    disable_nagle_algorithm = True
+    
+    # How long an idle stream waits before sending a keepalive comment.
+    stream_keepalive = 15.
+    # The most state events a second a stream can ask for (?rate=).
+    max_stream_rate = 50.
+    
+    # Bodies at least this big are compressed, for clients that accept
+    # it (see accepted_encoding).
+    compress_threshold = 512
+    
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+        
+    def end_headers(self):
+        """Counts each response, and closes the connection after the 
+        last one allowed, or straight away if other connections are 
+        waiting on a worker."""
+        self.requests_served += 1
+        if not self.close_connection and (
+            self.requests_served >= self.max_requests or 
+            self.server.busy()):
+                self.send_header("Connection", "close")
+        super().end_headers()
 
     def do_GET(self):
         """Serve a GET request. MUST BE WRAPPED by parent to eliminate
         state."""
-        f = self.send_head()
-        if f:
-            try:
-                self.copyfile(f, self.wfile)
-            finally:
-                f.close()
+        # Hardcode /<device>/stream for streaming.
+        path, _, query = self.path.partition('?')
+        device, _, endpoint = path.strip('/').partition('/')
+        if endpoint == 'stream' and device in self.server.streams:
+            self.send_stream(device, urllib.parse.parse_qs(query))
+            return
+            
+        body = self.send_head()
+        if body:
+            self.wfile.write(body)
 
     def do_HEAD(self):
         """Serve a HEAD request."""
-        f = self.send_head()
-        if f:
-            f.close()
+        self.send_head()
             
     def do_POST(self):
         ''' Serve a POST request.
         '''
-        content = self.rfile
+        # Nothing is postable yet. This also closes the connection, so
+        # the unread request body can't be mistaken for the next request.
+        self.send_error(501, "Unsupported method ('POST')")
 
     def send_head(self):
         """Common code for GET and HEAD commands.
 
         This sends the response code and MIME headers.
 
-        Return value is either a file object (which has to be copied
-        to the outputfile by the caller unless the command was HEAD,
-        and must be closed by the caller under all circumstances), or
-        None, in which case the caller has nothing further to do.
+        Return value is either the body as bytes (which has to be 
+        written to the outputfile by the caller unless the command was 
+        HEAD), or None, in which case the caller has nothing further to 
+        do.
 
         """
-        # Hardcode path handling for RESTfulness.
-        # Don't forget to strip the original '/' to avoid having an empty
-        # string at the beginning of the path string. Could do this other ways
-        # as well, this is a bit ungraceful
-        restful = self.path.strip('/').split('/')
+        # Hardcode /<device>/history for range queries.
+        path, _, query = self.path.partition('?')
+        device, _, endpoint = path.strip('/').partition('/')
+        if endpoint == 'history' and device in self.server.history:
+            return self.send_history(device, urllib.parse.parse_qs(query))
+        # And /<device>/agg for aggregates.
+        if endpoint == 'agg' and device in self.server.history:
+            return self.send_aggregate(device, urllib.parse.parse_qs(query))
+        # And /<device>/binary for binary records.
+        if endpoint == 'binary' and device in self.server.records:
+            return self.send_record(device)
+            
+        # Pollers that already have this version get a bodyless 304, 
+        # before anything is serialized. A version's body never changes,
+        # so neither does whether it was compressed: the client has one
+        # of these two.
+        snapshot = self.server.snapshot()
+        encoding = accepted_encoding(self.headers.get('Accept-Encoding'))
+        for candidate in dict.fromkeys((encoding, None)):
+            if self.not_modified(snapshot, candidate):
+                self.send_response(304)
+                self.send_header("Vary", "Accept-Encoding")
+                self.send_validators(snapshot, candidate)
+                self.end_headers()
+                return None
+        
+        # Hardcode path handling for RESTfulness. The server caches the
+        # serialized (and compressed) body, so this is usually just a 
+        # lookup.
         try:
-            _state = self.server.state_vector
-            for key in restful:
-                # Check to make sure there was a string
-                if key:
-                    # Mutate _state until we divide it into the desired key
-                    _state = _state[key]
-                else:
-                    break
+            body = self.server.serialize(self.path, snapshot)
         except KeyError:
-            self.send_response(404)
+            self.send_error(404)
             return None
+        encoding = self.accepted_encoding(body)
+        if encoding:
+            body = self.server.serialize(self.path, snapshot, encoding)
         
-        output_string = json.dumps(_state)
-        
-        # Open a temporary file for piping.
-        f = tempfile.TemporaryFile()
-        # Write the _state to f
-        f.write(output_string.encode())
-        # THIS IS REALLY IMPORTANT.
-        # Otherwise will return blank.
-        f.seek(0)
-        
-        # Begin the response sequence.
         self.send_response(200)
         ctype = 'text/plain'
         self.send_header("Content-type", ctype)
-        fs = os.fstat(f.fileno())
-        self.send_header("Content-Length", str(fs[6]))
-        self.send_header("Last-Modified", 
-            self.date_time_string(fs.st_mtime))
+        self.send_encoding(encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_validators(snapshot, encoding)
         self.end_headers()
+        return body
         
-        # Return the file-like object, to maintain compatibility with do_GET
-        return f
+    def accepted_encoding(self, body):
+        """Returns the content coding to send body with (or None), 
+        given the request's Accept-Encoding."""
+        if len(body) < self.compress_threshold:
+            return None
+        return accepted_encoding(self.headers.get('Accept-Encoding'))
+        
+    def send_encoding(self, encoding):
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        
+    def send_body(self, body):
+        """Sends the headers for a plain 200 response with body 
+        (compressing it, if accepted), and returns the body as sent 
+        (for send_head)."""
+        encoding = self.accepted_encoding(body)
+        if encoding:
+            body = compress_body(body, encoding)
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.send_encoding(encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        return body
+        
+    def send_record(self, device):
+        """Sends a device's state as a fixed-layout binary record (ex: 
+        aimms30.STATE_RECORD), with the same validators as its JSON."""
+        snapshot = self.server.snapshot()
+        # Check before packing: an up to date poller needs no body.
+        if self.not_modified(snapshot, 'record'):
+            self.send_response(304)
+            self.send_validators(snapshot, 'record')
+            self.end_headers()
+            return None
+        
+        body = self.server.pack_record(device, snapshot)
+        self.send_response(200)
+        self.send_header("Content-type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_validators(snapshot, 'record')
+        self.end_headers()
+        return body
+        
+    def send_history(self, device, query):
+        """Answers a range query on a device's history, ex:
+        /aimms/history?since=1500000000&until=1500000060&fields=tas,aoa
+        
+        since and until are unix times (inclusive; either can be left 
+        out), and fields is a comma-separated list of fields. The body
+        maps each packet type to its columns: 'timestamp', then each 
+        field (see TimeSeriesStore.query).
+        """
+        try:
+            since = _query_float(query, 'since')
+            until = _query_float(query, 'until')
+        except ValueError:
+            self.send_error(400, "Bad since or until")
+            return None
+        fields = _query_list(query, 'fields')
+        
+        history = self.server.history[device].query(since, until, fields)
+        return self.send_body(json.dumps(history).encode())
+        
+    def send_aggregate(self, device, query):
+        """Answers an aggregate query on a device's history, ex:
+        /aimms/agg?field=tas&bucket=1s&since=1500000000
+        
+        bucket is the bucket width (ex: 1s, 10s, 5m or 1h); it must be
+        a multiple of one of the widths aggregated (by default 1s, so 
+        there are no sub-second buckets). since and until are 
+        as for send_history. The body maps each packet type with the field
+        to its buckets: 'start', 'count', 'mean', 'min', 'max' and 
+        'last' (see BucketAggregator.query).
+        """
+        field = query.get('field', [None])[0]
+        if not field:
+            self.send_error(400, "Missing field")
+            return None
+        try:
+            width = _query_duration(query, 'bucket')
+            since = _query_float(query, 'since')
+            until = _query_float(query, 'until')
+        except ValueError:
+            self.send_error(400, "Bad bucket, since or until")
+            return None
+        if width is None:
+            self.send_error(400, "Missing bucket")
+            return None
+        
+        history = self.server.history[device]
+        try:
+            aggregates = history.aggregate(field, width, since, until)
+        except ValueError as exc:
+            self.send_error(400, str(exc))
+            return None
+        return self.send_body(json.dumps(aggregates).encode())
+        
+    def send_stream(self, device, query):
+        """Streams a device as text/event-stream (Server-Sent Events),
+        until the client goes away or the server shuts down.
+        
+        By default, every packet published to the device's broadcaster
+        is sent as its own event, buffered per client and dropping the
+        oldest if the client falls behind (those dropped are counted in
+        a 'dropped' event). With ?rate=N, the device's state is instead
+        sent as a 'state' event at most N times a second, whenever it 
+        has changed. N can't be over max_stream_rate.
+        """
+        try:
+            rate = _query_float(query, 'rate')
+        except ValueError:
+            self.send_error(400, "Bad rate")
+            return
+        if rate is not None and not 0 < rate <= self.max_stream_rate:
+            self.send_error(400, "Bad rate")
+            return
+        # Each stream holds a worker for as long as it's open.
+        if not self.server.stream_slots.acquire(blocking=False):
+            self.send_error(503, "Too many streams")
+            return
+        try:
+            self._send_stream(device, rate)
+        finally:
+            self.server.stream_slots.release()
+            
+    def _send_stream(self, device, rate):
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        
+        try:
+            if rate is None:
+                self._stream_packets(self.server.streams[device])
+            else:
+                # Check in at least once per keepalive, however slow the
+                # rate (that's also how dead clients are noticed).
+                rate = max(rate, 1 / self.stream_keepalive)
+                self._stream_state(device, 1 / rate)
+        except (ConnectionError, OSError):
+            pass
+            
+    def _stream_packets(self, broadcaster):
+        subscription = broadcaster.subscribe()
+        try:
+            last_sent = time.monotonic()
+            while not self.server.closing.is_set():
+                items, dropped = subscription.get(1.)
+                events = []
+                if dropped:
+                    events.append(b'event: dropped\ndata: ' + 
+                                  str(dropped).encode() + b'\n\n')
+                for item in items:
+                    events.append(b'data: ' + item.encode() + b'\n\n')
+                if events:
+                    last_sent = time.monotonic()
+                    self.wfile.write(b''.join(events))
+                else:
+                    last_sent = self._stream_keepalive(last_sent)
+        finally:
+            broadcaster.unsubscribe(subscription)
+            
+    def _stream_state(self, device, interval):
+        path = '/' + device
+        version = None
+        last_sent = time.monotonic()
+        while not self.server.closing.is_set():
+            snapshot = self.server.snapshot()
+            if snapshot.version is None or snapshot.version != version:
+                version = snapshot.version
+                try:
+                    body = self.server.serialize(path, snapshot)
+                except KeyError:
+                    body = b'null'
+                last_sent = time.monotonic()
+                self.wfile.write(b'event: state\nid: ' + 
+                                 str(version).encode() + b'\ndata: ' + 
+                                 body + b'\n\n')
+            else:
+                last_sent = self._stream_keepalive(last_sent)
+            self.server.closing.wait(interval)
+            
+    def _stream_keepalive(self, last_sent):
+        """Sends a comment once a stream's been idle long enough (since
+        last_sent, in time.monotonic()); both to keep proxies from timing
+        it out, and to notice dead clients. Returns when the stream last
+        sent something."""
+        if time.monotonic() - last_sent < self.stream_keepalive:
+            return last_sent
+        self.wfile.write(b': keepalive\n\n')
+        return time.monotonic()
+        
+    def etag(self, snapshot, encoding=None):
+        """Returns the (strong) ETag of a state version, as sent with 
+        encoding (or in some other representation, ex: 'record')."""
+        etag = '{}-{}'.format(self.server.epoch, snapshot.version)
+        if encoding:
+            etag += '-' + encoding
+        return '"' + etag + '"'
+        
+    def send_validators(self, snapshot, encoding=None):
+        """Sends the ETag and Last-Modified headers for a snapshot, if
+        it's versioned.
+        
+        Dates are only to the second, and the state can change many 
+        times a second, so Last-Modified is only sent once the second 
+        the state was published in is over (nothing later can then 
+        share its date). Until then, only the ETag validates."""
+        if snapshot.version is None:
+            return
+        self.send_header("ETag", self.etag(snapshot, encoding))
+        published = int(snapshot.published)
+        if published < int(time.time()):
+            self.send_header("Last-Modified", 
+                self.date_time_string(published))
+            
+    def not_modified(self, snapshot, encoding=None):
+        """Returns True if the request's conditional headers show the 
+        client already has this version of the state.
+        
+        If-None-Match takes precedence. If-Modified-Since matches if the
+        state wasn't changed after that date (per RFC 7232), but never 
+        while the state's second is still running (see send_validators);
+        pollers should prefer ETags.
+        """
+        if snapshot.version is None:
+            return False
+        
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etag = self.etag(snapshot, encoding)
+            for tag in if_none_match.split(','):
+                tag = tag.strip()
+                # Weak comparison, per RFC 7232
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag == '*' or tag == etag:
+                    return True
+            return False
+            
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError):
+                return False
+            # A -0000 zone parses as naive, but HTTP dates are all GMT.
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            published = int(snapshot.published)
+            return (published < int(time.time()) and 
+                    published <= since.timestamp())
+        
+        return False
         
         
     def _dont_send_head(self):
@@ -2,16 +2,47 @@ import argparse
 import aimms30
 
 parser = argparse.ArgumentParser()
-parser.add_argument('serial', help='Which serial port to use.')
+parser.add_argument('serial', help='Which serial port to use (ignored when '
+                    'replaying).')
 parser.add_argument('http', type=int, help='Which http port to use.')
 parser.add_argument('-l', '--log', help='Log data to file.', action='store_true')
+parser.add_argument('-r', '--raw', help='Record raw serial data to file.',
+                    action='store_true')
 parser.add_argument('-d', '--debug', help='Show realtime data in console.',
                     action='store_true')
+parser.add_argument('-e', '--event', help='Block on events instead of polling.',
+                    action='store_true')
+parser.add_argument('-a', '--asyncio', help='Run everything in one asyncio '
+                    'event loop instead of threads.', action='store_true')
+parser.add_argument('--replay', help='Replay a recorded log (ex: '
+                    'sample_data_1.txt) instead of reading the serial port.')
+parser.add_argument('--speed', type=float, default=1., help='Replay speed, as '
+                    'a multiple of real time. 0 replays as fast as possible.')
+parser.add_argument('--rotate-bytes', type=int, help='Start a new log segment '
+                    'after this many bytes.')
+parser.add_argument('--rotate-interval', type=float, help='Start a new log '
+                    'segment after this many seconds.')
+parser.add_argument('--compress', choices=sorted(
+                    aimms30.core.FileRecorder.COMPRESSORS), help='Compress '
+                    'each log segment once it is closed.')
 
 args = parser.parse_args()
 
-aimms = aimms30.UAVMaster(aimms_port = args.serial,
-                          http_port = args.http,
-                          record_to_file = args.log,
-                          print_to_terminal = args.debug)
+if args.asyncio:
+    aimms = aimms30.AsyncUAVMaster(aimms_port = args.serial,
+                                   http_port = args.http,
+                                   record_to_file = args.log,
+                                   print_to_terminal = args.debug)
+else:
+    aimms = aimms30.UAVMaster(aimms_port = args.serial,
+                              http_port = args.http,
+                              record_to_file = args.log,
+                              print_to_terminal = args.debug,
+                              record_raw = args.raw,
+                              event_driven = args.event,
+                              replay = args.replay,
+                              replay_speed = args.speed,
+                              rotate_bytes = args.rotate_bytes,
+                              rotate_interval = args.rotate_interval,
+                              compression = args.compress)
 aimms.run()
\ No newline at end of file